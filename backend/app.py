@@ -5,30 +5,45 @@ load_dotenv()
 
 import json
 import os
-from datetime import date
+import sys
+import threading
 
-from flask import Flask, jsonify, request
+from flask import Flask, copy_current_request_context, jsonify, request
 from flask_cors import CORS
 from openai import OpenAI
+from werkzeug.serving import is_running_from_reloader
 
 from .src.db import Database
+from .src.embeddings import model_ready, warm_up
+from .src.emr import get_patient_records
+from .src.pipeline import Stage, run_stages
 from .src.similar_patients import find_similar_emr
 from .src.summarizer import (
+    NcbiError,
     build_queries,
-    fetch_abstract,
+    cached_patient_summary,
+    get_structured_summaries,
+    probe_tiers,
+    pubmed_cache,
     search_pubmed,
-    summarize_patient_info,
-    summarize_structured,
+    summarize_articles,
 )
 
 app = Flask(__name__)
 CORS(app)
 
+# Pooled, every request checks out its own connection
 db = Database()
-connection = db.get_connection()
 
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
+# Load the embedding model in the background at startup instead of on the
+# first similar patient search. /ready answers 503 until it is loaded
+warm_up_model = os.environ.get("WARM_UP_MODEL", "1") == "1"
+
+# Probe all PubMed query tiers at the same time instead of one after another
+concurrent_tier_probing = os.environ.get("CONCURRENT_TIER_PROBING", "1") == "1"
+
 
 def parse_user_input(raw_input):
     """
@@ -59,6 +74,12 @@ def parse_user_input(raw_input):
         return {"error": str(e)}
 
 
+@app.errorhandler(NcbiError)
+def ncbi_error(e):
+    # PubMed could not be searched, which is not the same as finding nothing
+    return jsonify({"error": str(e)}), 502
+
+
 @app.route("/all_requests", methods=["POST"])
 def all_requests():
     """
@@ -68,25 +89,40 @@ def all_requests():
     patient_id = data.get("patient_id")
     patient_info = data.get("patient_info")
 
-    parsed_info = parse_input(patient_info)
+    # Stages only wait on the results they need, so parsing the input, the EMR
+    # summary and the similar patient search all run at the same time
+    def parsed_info():
+        return parse_input(patient_info)
 
-    # Step 2: fetch patient EMR from DB and summarize EMR
-    patient_records = get_patient_records(patient_id)
-    summary_info = summarize_patient_info(patient_records)
+    def emr_summary():
+        patient_records = get_patient_records(db, patient_id)
+        return cached_patient_summary(db, patient_records)
 
-    # Step 3: fetch similar patients
-    similar_patients = find_similar_emr(patient_id, patient_info, db)
-    similar_patients_list = []
-    for key, value in similar_patients.items():
-        similar_patients_list.append({"id": key, "summary": value})
+    def similar_patients():
+        similar_patients = find_similar_emr(patient_id, patient_info, db)
+        return [{"id": key, "summary": value} for key, value in similar_patients.items()]
 
-    # Step 4: combine parsed input and summary into one query context
-    combined_info = {"parsed_input": parsed_info, "emr_summary": summary_info}
+    def case_study(parsed_info, summary_info):
+        # combine parsed input and summary into one query context
+        combined_info = {"parsed_input": parsed_info, "emr_summary": summary_info}
+        return search_patient(combined_info)
 
-    case_study = search_patient(combined_info)
+    results = run_stages(
+        {
+            "parsed_info": Stage(copy_current_request_context(parsed_info)),
+            "emr_summary": Stage(copy_current_request_context(emr_summary)),
+            "similar_patients": Stage(copy_current_request_context(similar_patients)),
+            "case_study": Stage(
+                copy_current_request_context(case_study), "parsed_info", "emr_summary"
+            ),
+        }
+    )
 
     return jsonify(
-        {"case_study": case_study, "similar_patients": similar_patients_list}
+        {
+            "case_study": results["case_study"],
+            "similar_patients": results["similar_patients"],
+        }
     )
 
 
@@ -128,122 +164,43 @@ def search_patient(patient):
     queries = build_queries(patient)
     print("Built queries:", queries, flush=True)
 
-    tier_with_results = None
-    first_query = None
-    ids = []
-
-    # Step 1 — Find first tier with results without calling OpenAI
-    for tier_num, query in enumerate(queries, start=1):
-        print(f"Checking Tier {tier_num} query: {query}", flush=True)
-        ids = search_pubmed(query, max_results=3)
-        if ids:
-            tier_with_results = tier_num
-            first_query = query
-            print(f"Tier {tier_num} has results: {ids}", flush=True)
-            break  # Stop at first tier with results
+    if concurrent_tier_probing:
+        # Step 1 — Check every tier at once and keep the first one with results
+        tier_with_results, first_query, ids = probe_tiers(queries, max_results=3)
+        if tier_with_results:
+            print(f"Tier {tier_with_results} has results: {ids}", flush=True)
+    else:
+        tier_with_results = None
+        first_query = None
+        ids = []
+
+        # Step 1 — Find first tier with results without calling OpenAI
+        for tier_num, query in enumerate(queries, start=1):
+            print(f"Checking Tier {tier_num} query: {query}", flush=True)
+            ids = search_pubmed(query, max_results=3)
+            if ids:
+                tier_with_results = tier_num
+                first_query = query
+                print(f"Tier {tier_num} has results: {ids}", flush=True)
+                break  # Stop at first tier with results
 
     if not tier_with_results:
         return {"patient": patient, "results": {"query": "", "summaries": []}}
 
-    # Step 2 — Call OpenAI for the first tier with results to summarize
-    summaries = []
-    for pubmed_id in ids:
-        name, abstract = fetch_abstract(pubmed_id)
-        structured_summary = summarize_structured(abstract)
-        try:
-            structured_json = json.loads(structured_summary)
-        except Exception:
-            structured_json = {"raw_summary": structured_summary}
-        summaries.append(
-            {"name": name, "pubmed_id": pubmed_id, "summary": structured_json}
-        )
+    # Step 2 — Fetch all abstracts in one call and summarize them concurrently
+    summaries = summarize_articles(ids)
 
     results = {"query": first_query, "summaries": summaries}
 
     return {"patient": patient, "results": results}
 
 
-def get_patient_records(patient_id, first_name=None, last_name=None):
-    cursor = connection.cursor()
-
-    # Base query (patient_id required)
-    query = "SELECT id, first_name, last_name, gender, birth_date, deceased FROM patients WHERE id = %s"
-    params = [patient_id]
-
-    if first_name:
-        query += " AND first_name = %s"
-        params.append(first_name)
-    if last_name:
-        query += " AND last_name = %s"
-        params.append(last_name)
-
-    cursor.execute(query, tuple(params))
-    patient = cursor.fetchone()
-    if not patient:
-        return None
-
-    # Calculate age
-    birth_date = patient[4]
-    age = None
-    if birth_date:
-        today = date.today()
-        age = (
-            today.year
-            - birth_date.year
-            - ((today.month, today.day) < (birth_date.month, birth_date.day))
-        )
-
-    # Fetch conditions
-    cursor.execute(
-        "SELECT id, code, onset, abatement FROM conditions WHERE patient_id = %s",
-        (patient_id,),
-    )
-    conditions = cursor.fetchall()
-    conditions_list = [
-        {
-            "id": str(c[0]),
-            "code": str(c[1]),
-            "onset": str(c[2]) if c[2] else None,
-            "abatement": str(c[3]) if c[3] else None,
-        }
-        for c in conditions
-    ]
-
-    # Fetch observations
-    cursor.execute(
-        "SELECT id, code, value, unit, date FROM observations WHERE patient_id = %s",
-        (patient_id,),
-    )
-    observations = cursor.fetchall()
-    observations_list = [
-        {
-            "id": str(o[0]),
-            "code": str(o[1]),
-            "value": str(o[2]) if o[2] is not None else None,
-            "unit": str(o[3]) if o[3] is not None else None,
-            "date": str(o[4]) if o[4] else None,
-        }
-        for o in observations
-    ]
-
-    return {
-        "id": str(patient[0]),
-        "first_name": str(patient[1]),
-        "last_name": str(patient[2]),
-        "gender": str(patient[3]) if patient[3] else "unknown",
-        "age": age,
-        "deceased": patient[5],
-        "conditions": conditions_list,
-        "observations": observations_list,
-    }
-
-
 def patient_summary(patient_id, first_name=None, last_name=None):
-    records = get_patient_records(patient_id, first_name, last_name)
+    records = get_patient_records(db, patient_id, first_name, last_name)
     if not records:
         return jsonify({"error": "Patient not found"}), 404
 
-    summary = summarize_patient_info(records)
+    summary = cached_patient_summary(db, records)
 
     return jsonify(
         {
@@ -258,12 +215,12 @@ def patient_summary(patient_id, first_name=None, last_name=None):
 # --------------------------
 @app.route("/patients_list", methods=["GET"])
 def patients_list():
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "SELECT id, first_name, last_name FROM patients ORDER BY last_name, first_name;"
-        )
-        rows = cursor.fetchall()
+        with db.transaction() as cursor:
+            cursor.execute(
+                "SELECT id, first_name, last_name FROM patients ORDER BY last_name, first_name;"
+            )
+            rows = cursor.fetchall()
 
         patients = [
             {"id": str(row[0]), "first_name": str(row[1]), "last_name": str(row[2])}
@@ -276,6 +233,69 @@ def patients_list():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify(
+        {"pubmed": pubmed_cache.stats(), "embeddings": db.embedding_cache.stats()}
+    )
+
+
+@app.route("/pool_stats", methods=["GET"])
+def pool_stats():
+    return jsonify(db.pool_stats())
+
+
+@app.route("/ready")
+def ready():
+    """Readiness probe, the embedding model is loaded and requests won't stall on it"""
+    if not model_ready():
+        return jsonify({"ready": False, "embedding_model": "loading"}), 503
+    return jsonify({"ready": True, "embedding_model": "loaded"})
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def start_warm_up():
+    """Load the embedding model in a background thread, once per process"""
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name="embedding-warm-up", daemon=True).start()
+
+
+def may_be_reloader_watcher() -> bool:
+    """
+    Whether this could be the Werkzeug reloader's watcher process, which only
+    restarts the server. The reloader runs with debug or --reload, from
+    `flask run` or from app.run(debug=True) below, and marks the serving
+    process it starts with WERKZEUG_RUN_MAIN.
+    """
+    if is_running_from_reloader():
+        return False
+    return (
+        __name__ == "__main__"
+        or "--reload" in sys.argv
+        or "--debug" in sys.argv
+        or os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true")
+    )
+
+
+@app.before_request
+def warm_up_on_first_request():
+    # Covers processes where warm-up was held back at startup, only the
+    # serving process gets requests
+    if warm_up_model and not _warm_up_started:
+        start_warm_up()
+
+
+if warm_up_model and not may_be_reloader_watcher():
+    start_warm_up()
+
+
 @app.route("/health")
 def hello():
     return "The server has been eating apples 🍎!"
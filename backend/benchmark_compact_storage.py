@@ -0,0 +1,121 @@
+import os
+import sys
+
+import numpy as np
+
+from src.db import Database
+
+# Number of stored embeddings used as queries, and neighbours compared per query
+query_count = int(os.environ.get("BENCHMARK_QUERIES", 20))
+top_k = int(os.environ.get("BENCHMARK_TOP_K", 10))
+
+# Bytes per stored embedding: 4 or 2 bytes per dimension, or 1 bit, plus the header
+DIMENSIONS = 384
+BYTES_PER_VECTOR = {
+    "full": 4 * DIMENSIONS + 8,
+    "halfvec": 2 * DIMENSIONS + 8,
+    "binary": DIMENSIONS // 8 + 8,
+}
+
+# Nearest ids to %(q)s in each representation, searched exactly (no index)
+# so the recall reflects the representation rather than the index
+SEARCHES = {
+    "full": """
+        SELECT id FROM observations WHERE embedding IS NOT NULL
+        ORDER BY embedding::vector <=> %(q)s::vector
+        LIMIT %(k)s
+    """,
+    "halfvec": """
+        SELECT id FROM observations WHERE embedding IS NOT NULL
+        ORDER BY embedding::halfvec(384) <=> %(q)s::halfvec(384)
+        LIMIT %(k)s
+    """,
+    "binary": """
+        SELECT id FROM observations WHERE embedding IS NOT NULL
+        ORDER BY binary_quantize(embedding::vector)::bit(384)
+                 <~> binary_quantize(%(q)s::vector)
+        LIMIT %(k)s
+    """,
+    "binary + re-rank": """
+        SELECT id FROM (
+            SELECT id, embedding FROM observations WHERE embedding IS NOT NULL
+            ORDER BY binary_quantize(embedding::vector)::bit(384)
+                     <~> binary_quantize(%(q)s::vector)
+            LIMIT %(candidates)s
+        ) candidates
+        ORDER BY embedding::vector <=> %(q)s::vector
+        LIMIT %(k)s
+    """,
+}
+
+
+def sample_queries(db: Database, count: int) -> list[str]:
+    with db.transaction() as cursor:
+        cursor.execute(
+            """
+            SELECT embedding::vector::text FROM observations
+            WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s
+            """,
+            (count,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def current_sizes(db: Database) -> tuple[int, int, int, int]:
+    """Returns: (embedded rows, table bytes, embedding index bytes, embedding_cache bytes)"""
+    with db.transaction() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM observations WHERE embedding IS NOT NULL),
+                pg_table_size('observations'),
+                COALESCE(pg_relation_size(to_regclass('observations_embedding_idx')), 0),
+                COALESCE(pg_total_relation_size(to_regclass('embedding_cache')), 0)
+            """
+        )
+        return cursor.fetchone()
+
+
+def main(rerank_factors: list[int]):
+    """Report the size of each observation embedding storage mode against its recall@k"""
+    db = Database()
+    queries = sample_queries(db, query_count)
+    if not queries:
+        print("No observation embeddings stored")
+        return
+
+    rows, table_bytes, index_bytes, cache_bytes = current_sizes(db)
+    print(
+        f"observations: {rows} embedded rows, table {table_bytes / 2**20:.1f} MiB, "
+        f"embedding index {index_bytes / 2**20:.1f} MiB"
+    )
+    # Query-time texts only, always full precision, not changed by compact
+    print(f"embedding_cache: {cache_bytes / 2**20:.1f} MiB")
+    for mode, size in BYTES_PER_VECTOR.items():
+        print(f"  {mode}: {size} bytes per vector, ~{size * rows / 2**20:.1f} MiB of vectors")
+
+    with db.transaction() as cursor:
+        db.set_search_params(cursor, exact=True)
+
+        def nearest(name, query, factor=1):
+            cursor.execute(
+                SEARCHES[name], {"q": query, "k": top_k, "candidates": top_k * factor}
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+        exact = [nearest("full", query) for query in queries]
+
+        def recall(name, factor=1):
+            found = [nearest(name, query, factor) for query in queries]
+            return np.mean([len(f & e) / len(e) for f, e in zip(found, exact) if e])
+
+        print(f"recall@{top_k} against full precision, {len(queries)} queries:")
+        print(f"  halfvec: {recall('halfvec'):.3f}")
+        print(f"  binary: {recall('binary'):.3f}")
+        for factor in rerank_factors:
+            print(f"  binary + re-rank of {top_k * factor}: {recall('binary + re-rank', factor):.3f}")
+
+
+if __name__ == "__main__":
+    # Re-rank factors to compare, e.g. python benchmark_compact_storage.py 2 4 8
+    main([int(arg) for arg in sys.argv[1:]] or [2, 4, 8])
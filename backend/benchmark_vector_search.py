@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from src.db import Database
+
+# Number of stored embeddings used as queries, and neighbours compared per query
+query_count = int(os.environ.get("BENCHMARK_QUERIES", 50))
+top_k = int(os.environ.get("BENCHMARK_TOP_K", 10))
+
+EF_SEARCH_VALUES = [10, 20, 40, 80, 160, 320]
+PROBES_VALUES = [1, 2, 5, 10, 20, 50]
+
+
+def sample_queries(db: Database, table: str, count: int) -> list:
+    with db.transaction() as cursor:
+        cursor.execute(
+            f"SELECT embedding FROM {table} WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s",
+            (count,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def column_type(db: Database, table: str) -> str:
+    """vector(384), or halfvec(384) after `python migrate.py compact halfvec`"""
+    with db.transaction() as cursor:
+        cursor.execute(
+            """
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attname = 'embedding'
+            """,
+            (table,),
+        )
+        return cursor.fetchone()[0]
+
+
+def search(db: Database, table: str, queries: list, **params) -> tuple[list[set], float]:
+    """
+    Top k ids for each query with the given set_search_params.
+    Returns: (one id set per query, median milliseconds per query)
+    """
+    query_type = column_type(db, table)
+    results, timings = [], []
+    with db.transaction() as cursor:
+        db.set_search_params(cursor, **params)
+        for query in queries:
+            start = time.perf_counter()
+            cursor.execute(
+                f"""
+                SELECT id FROM {table}
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> %s::{query_type}
+                LIMIT %s
+                """,
+                (query, top_k),
+            )
+            results.append({row[0] for row in cursor.fetchall()})
+            timings.append((time.perf_counter() - start) * 1000)
+    return results, float(np.median(timings))
+
+
+def index_type(db: Database, table: str) -> str | None:
+    with db.transaction() as cursor:
+        cursor.execute(
+            """
+            SELECT am.amname FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE c.relname = %s
+            """,
+            (f"{table}_embedding_idx",),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
+def main(tables: list[str]):
+    """Report recall@k and latency of the embedding indexes against exact search"""
+    db = Database()
+
+    for table in tables:
+        queries = sample_queries(db, table, query_count)
+        if not queries:
+            print(f"{table}: no embeddings stored")
+            continue
+
+        method = index_type(db, table)
+        exact, exact_ms = search(db, table, queries, exact=True)
+        print(f"{table} ({method or 'no index'}), {len(queries)} queries, k={top_k}")
+        print(f"  exact: recall 1.000, {exact_ms:.2f} ms/query")
+
+        if method == "hnsw":
+            settings = [("ef_search", value) for value in EF_SEARCH_VALUES]
+        elif method == "ivfflat":
+            settings = [("probes", value) for value in PROBES_VALUES]
+        else:
+            continue
+
+        for name, value in settings:
+            found, ms = search(db, table, queries, **{name: value})
+            recall = np.mean(
+                [len(a & e) / len(e) for a, e in zip(found, exact) if e]
+            )
+            print(
+                f"  {name}={value}: recall {recall:.3f}, {ms:.2f} ms/query "
+                f"({exact_ms / ms:.1f}x faster)"
+            )
+
+
+if __name__ == "__main__":
+    # e.g. python benchmark_vector_search.py observations
+    main(sys.argv[1:] or ["observations", "patients"])
@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from src.db import Database
+from src.embedding_backends import EMBEDDING_DIMENSION, load_backend
+
+# Number of stored observations compared, and neighbours per query for recall
+sample_size = int(os.environ.get("PARITY_SAMPLE_SIZE", 5000))
+top_k = int(os.environ.get("PARITY_TOP_K", 10))
+
+# Symptom style queries, like the ones find_similar_emr searches with
+QUERIES = [
+    "Observation: Body temperature | Value: 39.2 Cel",
+    "Observation: Heart rate | Value: 120 /min",
+    "Observation: Systolic blood pressure | Value: 160 mm[Hg]",
+    "Observation: Oxygen saturation in Arterial blood | Value: 88 %",
+    "Observation: Respiratory rate | Value: 28 /min",
+    "Observation: Pain severity - 0-10 verbal numeric rating | Value: 8",
+    "Observation: Body mass index | Value: 35 kg/m2",
+    "Observation: Glucose | Value: 250 mg/dL",
+    "Observation: Hemoglobin A1c | Value: 9.1 %",
+    "Observation: Cough",
+    "Observation: Shortness of breath",
+    "Observation: Headache",
+]
+
+
+def sample_texts(db: Database, limit: int) -> list[str]:
+    """Observation texts, built the way observation_to_string does, from stored rows"""
+    with db.transaction() as cursor:
+        cursor.execute(
+            "SELECT code, value, unit, date FROM observations ORDER BY random() LIMIT %s",
+            (limit,),
+        )
+        rows = cursor.fetchall()
+
+    texts = []
+    for code, value, unit, date in rows:
+        parts = [f"Observation: {code}"] if code else []
+        if value is not None:
+            parts.append(f"Value: {value} {unit}" if unit else f"Value: {value}")
+        if date:
+            parts.append(f"Date: {date.isoformat()}")
+        texts.append(" | ".join(parts) if parts else "Unknown observation")
+    return texts
+
+
+def normalized(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def timed_encode(backend, texts: list[str]) -> tuple[np.ndarray, float]:
+    """Returns: (unit vectors, texts per second)"""
+    start = time.perf_counter()
+    vectors = backend.encode(texts, batch_size=256)
+    return normalized(vectors), len(texts) / (time.perf_counter() - start)
+
+
+def query_latency(backend) -> float:
+    """Median milliseconds to embed one query, as the search endpoints do"""
+    timings = []
+    for query in QUERIES:
+        start = time.perf_counter()
+        backend.encode(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def top_neighbours(queries: np.ndarray, corpus: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ corpus.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def main(candidates: list[str]):
+    """Compare each candidate backend against the torch reference"""
+    db = Database()
+    texts = sample_texts(db, sample_size)
+    if not texts:
+        print("No observations stored, run generate_embeddings.py first")
+        return
+
+    reference = load_backend("torch")
+    reference_corpus, reference_rate = timed_encode(reference, texts)
+    reference_queries = normalized(reference.encode(QUERIES))
+    reference_neighbours = top_neighbours(reference_queries, reference_corpus, top_k)
+
+    print(f"Compared on {len(texts)} observations and {len(QUERIES)} queries, k={top_k}")
+    print(
+        f"  torch: {reference_rate:.0f} texts/s, "
+        f"{query_latency(reference):.1f} ms/query"
+    )
+
+    for name in candidates:
+        backend = load_backend(name)
+        corpus, rate = timed_encode(backend, texts)
+        queries = normalized(backend.encode(QUERIES))
+        if corpus.shape[1] != EMBEDDING_DIMENSION:
+            print(f"  {name}: produced {corpus.shape[1]}-dim vectors, expected {EMBEDDING_DIMENSION}")
+            continue
+
+        # Same text, reference vs candidate vector
+        agreement = np.sum(corpus * reference_corpus, axis=1)
+
+        # Share of the reference top-k neighbours the candidate also finds,
+        # searching with its own query vectors over its own stored vectors
+        neighbours = top_neighbours(queries, corpus, top_k)
+        recall = np.mean(
+            [
+                len(set(found) & set(expected)) / top_k
+                for found, expected in zip(neighbours, reference_neighbours)
+            ]
+        )
+
+        # Candidate queries searched against vectors stored by the reference,
+        # as happens right after switching backends without re-embedding
+        mixed = top_neighbours(queries, reference_corpus, top_k)
+        mixed_recall = np.mean(
+            [
+                len(set(found) & set(expected)) / top_k
+                for found, expected in zip(mixed, reference_neighbours)
+            ]
+        )
+
+        print(
+            f"  {name}: {rate:.0f} texts/s ({rate / reference_rate:.1f}x), "
+            f"{query_latency(backend):.1f} ms/query"
+        )
+        print(
+            f"    cosine to torch: mean {agreement.mean():.4f}, min {agreement.min():.4f}"
+        )
+        print(
+            f"    recall@{top_k}: {recall:.3f} (delta {recall - 1:+.3f}), "
+            f"against torch vectors {mixed_recall:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    # Backends to check, e.g. python check_embedding_parity.py onnx onnx-int8
+    main(sys.argv[1:] or ["onnx", "onnx-int8"])
@@ -1,57 +1,54 @@
 import glob
-import json
 import os
 
-from fhirclient.models.bundle import Bundle
 from src.db import Database
-from tqdm import tqdm
-
-db = Database()
-
-
-def process_file(file: str):
-    """Process FHIR bundle file and save to database with embeddings"""
-    try:
-        with open(file, "r") as f:
-            bundle_json = json.load(f)
-
-        # Load the bundle
-        bundle = Bundle(bundle_json)
-
-        # First pass: Process and commit all patients
-        for entry in bundle.entry or []:
-            resource = entry.resource
-            if resource is None:
-                continue
-
-            rtype = resource.resource_type
-            if rtype == "Patient":
-                db.save_patient(resource)
-
-        db.commit_connection()
-
-        # Second pass: Process observations and conditions
-        for entry in bundle.entry or []:
-            resource = entry.resource
-            if resource is None:
-                continue
-
-            rtype = resource.resource_type
-            if rtype == "Observation":
-                db.save_observation(resource)
-            elif rtype == "Condition":
-                db.save_condition(resource)
-
-        # Final commit for observations and conditions
-        db.commit_connection()
-
-    except Exception as e:
-        print(f"Error processing file {file}: {e}")
-        db.rollback_commit()
-
-
-def process_directory(directory_path: str, max_files: int | None = None):
-    """Process multiple FHIR files from a directory with a progress bar"""
+from src.ingestion import (
+    embed_observation_codes,
+    embed_parsed,
+    parse_chunks,
+    run_pipeline,
+    write_chunk,
+)
+
+# Number of texts encoded per forward pass of the embedding model
+embedding_batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+
+# Number of rows written per multi-row INSERT
+write_batch_size = int(os.environ.get("WRITE_BATCH_SIZE", 1000))
+
+# Number of processes parsing bundles, and files buffered between stages
+parser_workers = int(
+    os.environ.get("INGEST_PARSER_WORKERS", max((os.cpu_count() or 2) - 1, 1))
+)
+# Rows per chunk a file is streamed through the stages in, and rows buffered
+# between two stages. Memory depends on these rather than on bundle sizes
+chunk_rows = int(os.environ.get("INGEST_CHUNK_ROWS", 1000))
+queue_rows = int(os.environ.get("INGEST_QUEUE_ROWS", 8000))
+
+
+def process_file(db: Database, file: str, batch_size: int = embedding_batch_size) -> int:
+    """
+    Process FHIR bundle file and save to database with embeddings.
+    Returns: number of rows in batches that failed to save
+    """
+    files_in_progress = {}
+    for chunk in parse_chunks(file, chunk_rows=chunk_rows):
+        embed_parsed(db, [chunk], batch_size)
+        result = write_chunk(db, chunk, write_batch_size, files_in_progress)
+    if result["error"]:
+        raise RuntimeError(f"Failed to save {file}: {result['error']}")
+    embed_observation_codes(db, batch_size)
+    return result["failed_rows"]
+
+
+def process_directory(
+    db: Database,
+    directory_path: str,
+    max_files: int | None = None,
+    batch_size: int = embedding_batch_size,
+    workers: int = parser_workers,
+):
+    """Process multiple FHIR files from a directory through the staged ingestion pipeline"""
     # Get all JSON files in the directory
     json_pattern = os.path.join(directory_path, "*.json")
     json_files = glob.glob(json_pattern)
@@ -60,43 +57,51 @@ def process_directory(directory_path: str, max_files: int | None = None):
         print(f"No JSON files found in {directory_path}")
         return
 
-    # Sort files for consistent processing order
-    json_files.sort()
+    # Sort files for consistent processing order, normalized so the paths
+    # recorded in the ingestion manifest match across runs
+    json_files = sorted(os.path.normpath(file) for file in json_files)
 
     # Limit to max_files if specified
     if max_files:
         json_files = json_files[:max_files]
 
-    print(f"Processing {len(json_files)} files from {directory_path}")
-
-    successful_files = 0
-    failed_files = 0
-
-    # Use tqdm for progress bar
-    for file_path in tqdm(json_files, desc="Processing files", unit="file"):
-        try:
-            process_file(file_path)  # Call your existing process_file function
-            successful_files += 1
-        except Exception as e:
-            print(f"\nFailed to process {file_path}: {e}")
-            failed_files += 1
+    print(
+        f"Processing {len(json_files)} files from {directory_path} "
+        f"with {workers} parser workers"
+    )
+
+    stats = run_pipeline(
+        db,
+        json_files,
+        parser_workers=workers,
+        embedding_batch_size=batch_size,
+        write_batch_size=write_batch_size,
+        chunk_rows=chunk_rows,
+        queue_rows=queue_rows,
+    )
 
     print(f"\nProcessing complete:")
-    print(f"  Successfully processed: {successful_files} files")
-    print(f"  Failed: {failed_files} files")
+    print(f"  Successfully processed: {stats['successful_files']} files")
+    print(f"  Unchanged, skipped: {stats['skipped_files']} files")
+    print(f"  Failed: {stats['failed_files']} files")
+    print(f"  Rows in failed batches: {stats['failed_rows']}")
+    print(f"  New observation codes: {stats['new_codes']}")
+    print(f"  Clinical embeddings backfilled: {stats['backfilled_patients']} patients")
 
 
 def main(max_files: int | None = None):
     # Define the directory path
     directory_path = "output/fhir/"
 
+    db = Database()
+
     # Process files based on max_files parameter
     if max_files:
         print(f"Processing first {max_files} files from {directory_path}")
-        process_directory(directory_path, max_files)
+        process_directory(db, directory_path, max_files)
     else:
         print(f"Processing all files from {directory_path}")
-        process_directory(directory_path)
+        process_directory(db, directory_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import sys
+
+from src.db import Database
+from src.migrations import (
+    LATEST_VERSION,
+    convert_observation_storage,
+    current_version,
+    migrate,
+    rebuild_vector_indexes,
+)
+
+
+def main(target: int | None = None, reindex: bool = False, storage: str | None = None):
+    # Skip the version check, bringing the schema up to date is the point
+    db = Database(check_schema=False)
+
+    if reindex:
+        rebuild_vector_indexes(db)
+        return
+    if storage:
+        convert_observation_storage(db, storage)
+        return
+
+    applied = migrate(db, target)
+    with db.transaction() as cursor:
+        version = current_version(cursor)
+
+    if applied:
+        print(f"Applied {len(applied)} migrations, schema is at version {version}")
+    else:
+        print(f"Schema is up to date at version {version} (latest {LATEST_VERSION})")
+
+
+if __name__ == "__main__":
+    # Optionally migrate only up to a version: python migrate.py 3
+    # Or rebuild the embedding indexes with the current VECTOR_INDEX_TYPE,
+    # HNSW_* or IVFFLAT_LISTS settings: python migrate.py reindex
+    # Or convert observation embeddings to compact storage, see db.vector_storage:
+    # python migrate.py compact halfvec|binary|full
+    args = sys.argv[1:]
+    if args and args[0] == "reindex":
+        main(reindex=True)
+    elif args and args[0] == "compact":
+        main(storage=args[1] if len(args) > 1 else "halfvec")
+    else:
+        main(int(args[0]) if args else None)
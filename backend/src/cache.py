@@ -0,0 +1,137 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+# Default cache location lives next to the backend source, which is already a
+# mounted volume in docker-compose, so entries survive container restarts
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "cache.sqlite"
+)
+
+
+class DiskCache:
+    """
+    Persistent key/value cache backed by SQLite.
+
+    Entries are grouped by namespace, each namespace is capped at max_entries
+    and evicts its least recently used entries first. Safe to share between
+    threads, and between processes pointing at the same file.
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int | None = None):
+        self.path = path or os.environ.get("CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.max_entries = max_entries or int(
+            os.environ.get("CACHE_MAX_ENTRIES", 50000)
+        )
+
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        if self.path != ":memory:":
+            # WAL lets other worker processes read while one of them writes
+            self.connection.execute("PRAGMA journal_mode=WAL;")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            """
+        )
+        self.connection.execute(
+            """
+            CREATE INDEX IF NOT EXISTS cache_entries_lru
+            ON cache_entries (namespace, accessed_at);
+            """
+        )
+
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = defaultdict(int)
+
+    def get(self, namespace: str, key: str, ttl: float | None = None) -> Optional[str]:
+        """Return the cached value, or None if missing or older than ttl seconds"""
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+
+            if row is None or (ttl is not None and now - row[1] > ttl):
+                self.misses[namespace] += 1
+                return None
+
+            self.connection.execute(
+                "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, namespace, key),
+            )
+            self.hits[namespace] += 1
+            return row[0]
+
+    def set(self, namespace: str, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO cache_entries (namespace, key, value, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (namespace, key) DO UPDATE SET
+                    value = excluded.value,
+                    created_at = excluded.created_at,
+                    accessed_at = excluded.accessed_at
+                """,
+                (namespace, key, value, now, now),
+            )
+            self._evict(namespace)
+
+    def _evict(self, namespace: str):
+        """Drop the least recently used entries above max_entries"""
+        (count,) = self.connection.execute(
+            "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        if count <= self.max_entries:
+            return
+
+        self.connection.execute(
+            """
+            DELETE FROM cache_entries WHERE rowid IN (
+                SELECT rowid FROM cache_entries
+                WHERE namespace = ?
+                ORDER BY accessed_at
+                LIMIT ?
+            )
+            """,
+            (namespace, count - self.max_entries),
+        )
+        self.evictions[namespace] += count - self.max_entries
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters for this process, and entry counts per namespace"""
+        with self.lock:
+            sizes = dict(
+                self.connection.execute(
+                    "SELECT namespace, COUNT(*) FROM cache_entries GROUP BY namespace"
+                ).fetchall()
+            )
+        namespaces = set(sizes) | set(self.hits) | set(self.misses)
+        return {
+            namespace: {
+                "entries": sizes.get(namespace, 0),
+                "hits": self.hits[namespace],
+                "misses": self.misses[namespace],
+                "evictions": self.evictions[namespace],
+            }
+            for namespace in sorted(namespaces)
+        }
@@ -1,19 +1,100 @@
 import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 from typing import Final, Optional
 
-import psycopg2
-from fhirclient.models.condition import Condition
-from fhirclient.models.fhirdatetime import FHIRDateTime
-from fhirclient.models.observation import Observation
-from fhirclient.models.patient import Patient
 from pgvector.psycopg2 import register_vector
 from pgvector.psycopg2.vector import Vector
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from . import migrations
+from .embeddings import EmbeddingCache
+
+
+# Default query-time recall/speed trade-off of the embedding indexes, see
+# benchmark_vector_search.py. Unset keeps the server defaults
+# (hnsw.ef_search = 40, ivfflat.probes = 1)
+default_ef_search = os.environ.get("VECTOR_EF_SEARCH")
+default_probes = os.environ.get("VECTOR_PROBES")
+
+# How observation embeddings are stored and searched, set with
+# `python migrate.py compact <mode>`:
+#   full     vector(384) column, float32 HNSW index
+#   halfvec  halfvec(384) column, half the size of the table and index
+#   binary   vector(384) column, 1 bit per dimension HNSW index (32x smaller);
+#            candidates found by hamming distance are re-ranked by exact cosine
+vector_storage = os.environ.get("VECTOR_STORAGE", "full")
+
+# Candidates fetched per result in binary mode before the exact re-rank
+rerank_factor = int(os.environ.get("RERANK_FACTOR", 4))
+
+# Query-time embeddings kept in the embedding_cache table
+embedding_store_max_entries = int(os.environ.get("EMBEDDING_STORE_MAX_ENTRIES", 50000))
+
+# Embedding patients are compared by: "clinical", aggregated from their
+# conditions and observations, or "demographic", from fhir_stream.patient_to_string
+patient_similarity = os.environ.get("PATIENT_SIMILARITY", "clinical")
+
+
+def patient_embedding_column() -> str:
+    return "clinical_embedding" if patient_similarity == "clinical" else "embedding"
+
+
+# Nearest observations read per distinct patient returned by the
+# patient-grouped searches, patients often have many similar observations
+patient_candidate_factor = int(os.environ.get("PATIENT_CANDIDATE_FACTOR", 10))
+
+# Nearest observation codes looked up per symptom by find_similar_observations_by_code
+code_candidates = int(os.environ.get("CODE_CANDIDATES", 5))
+
+
+def nearest_observations_sql() -> str:
+    """
+    Subquery selecting (patient_id, code, similarity) of the observations
+    nearest to q.embedding (vector text), for the current vector_storage.
+    Takes the parameters given by nearest_observations_params.
+    """
+    if vector_storage == "halfvec":
+        return """
+            SELECT patient_id, code,
+                   1 - (embedding <=> q.embedding::halfvec) AS similarity
+            FROM observations
+            WHERE embedding IS NOT NULL
+            ORDER BY embedding <=> q.embedding::halfvec
+            LIMIT %s
+        """
+    if vector_storage == "binary":
+        return """
+            SELECT patient_id, code,
+                   1 - (embedding <=> q.embedding::vector) AS similarity
+            FROM (
+                SELECT patient_id, code, embedding
+                FROM observations
+                WHERE embedding IS NOT NULL
+                ORDER BY binary_quantize(embedding)::bit(384)
+                         <~> binary_quantize(q.embedding::vector)
+                LIMIT %s
+            ) candidates
+            ORDER BY embedding <=> q.embedding::vector
+            LIMIT %s
+        """
+    return """
+        SELECT patient_id, code,
+               1 - (embedding <=> q.embedding::vector) AS similarity
+        FROM observations
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> q.embedding::vector
+        LIMIT %s
+    """
 
-from .embeddings import (
-    embedding_model,
-    generate_observation_embedding,
-    generate_patient_embedding,
-)
+
+def nearest_observations_params(limit: int) -> tuple:
+    if vector_storage == "binary":
+        return (limit * rerank_factor, limit)
+    return (limit,)
 
 
 def extract_patient_id(reference: str | None) -> Optional[str]:
@@ -33,6 +114,78 @@ def extract_patient_id(reference: str | None) -> Optional[str]:
     return reference
 
 
+PATIENT_COLUMNS = (
+    "id",
+    "first_name",
+    "last_name",
+    "gender",
+    "birth_date",
+    "deceased",
+    "embedding",
+    "text_hash",
+)
+OBSERVATION_COLUMNS = (
+    "id",
+    "patient_id",
+    "code",
+    "value",
+    "unit",
+    "date",
+    "embedding",
+    "text_hash",
+)
+CONDITION_COLUMNS = ("id", "patient_id", "code", "onset", "abatement", "embedding")
+
+
+def row_values(row: dict, columns: tuple[str, ...]) -> tuple:
+    return tuple(row.get(column) for column in columns)
+
+
+def upsert_sql(table: str, columns: tuple[str, ...], multi_row: bool = False) -> str:
+    """INSERT ... ON CONFLICT (id) DO UPDATE statement for the given columns"""
+    values = "%s" if multi_row else "(" + ", ".join(["%s"] * len(columns)) + ")"
+    # A NULL embedding means the source text is unchanged, keep the stored one
+    updates = ",\n".join(
+        f"    {column} = COALESCE(EXCLUDED.{column}, {table}.{column})"
+        if column == "embedding"
+        else f"    {column} = EXCLUDED.{column}"
+        for column in columns
+        if column != "id"
+    )
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)})\n"
+        f"VALUES {values}\n"
+        f"ON CONFLICT (id) DO UPDATE SET\n{updates}"
+    )
+
+
+class BulkWriteResult:
+    """Outcome of a bulk upsert: rows written and the batches that failed"""
+
+    def __init__(self, table: str):
+        self.table = table
+        self.written = 0
+        # [(row ids in the batch, error message), ...]
+        self.failed: list[tuple[list[str], str]] = []
+
+    @property
+    def failed_rows(self) -> int:
+        return sum(len(ids) for ids, _error in self.failed)
+
+
+class KeepIdleConnectionPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that opens minconn connections up front but keeps
+    up to maxconn of them idle. psycopg2 closes every connection returned
+    while minconn are already idle, so concurrent checkouts would otherwise
+    open and close a connection each time.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+
 class Database:
     def __init__(
         self,
@@ -41,6 +194,9 @@ class Database:
         password: str | None = None,
         host: str | None = None,
         port: int | None = None,
+        min_connections: int | None = None,
+        max_connections: int | None = None,
+        check_schema: bool = True,
     ):
         # Use environment variables if provided, otherwise fallback
         self.dbname: Final[str] = dbname or os.environ.get("DB_NAME", "data")
@@ -50,78 +206,154 @@ class Database:
         )
         self.host: Final[str] = host or os.environ.get("DB_HOST", "localhost")
         self.port: Final[int] = port or int(os.environ.get("DB_PORT", 5432))
+        self.min_connections: Final[int] = min_connections or int(
+            os.environ.get("DB_POOL_MIN", 1)
+        )
+        self.max_connections: Final[int] = max_connections or int(
+            os.environ.get("DB_POOL_MAX", 10)
+        )
 
-        # Create db connection
-        self.connection = psycopg2.connect(
+        # Create db connection pool, shared by every thread using this Database
+        self.pool = KeepIdleConnectionPool(
+            self.min_connections,
+            self.max_connections,
             dbname=self.dbname,
             user=self.user,
             password=self.password,
             host=self.host,
             port=self.port,
         )
-        register_vector(self.connection)
-        self.cursor = self.connection.cursor()
-
-        # Initialize tables if not exists
-        self.init_tables()
+        # The pool raises when exhausted, so callers wait on a free slot instead
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        # Connections pgvector's types are registered on. Weak, so a closed
+        # connection drops out instead of its id being mistaken for a new one
+        self._registered = weakref.WeakSet()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "in_use": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "rollbacks": 0,
+            "discarded": 0,
+        }
+
+        # Connection pinned to this Database for multi-statement writes
+        # (ingestion), checked out on first use
+        self._session = None
+        self._session_cursor = None
+
+        # Only verify the schema version, migrate.py creates and changes tables
+        if check_schema:
+            migrations.check_schema(self)
+
+        # Embeddings of previously seen texts, backed by the embedding_cache table
+        self.embedding_cache = EmbeddingCache(store=self)
 
     def __del__(self):
-        self.cursor.close()
+        self.close()
+
+    def close(self):
+        """Return the pinned connection and close every pooled connection"""
+        pool = getattr(self, "pool", None)
+        if pool is None or pool.closed:
+            return
+        if self._session is not None:
+            self._session_cursor.close()
+            self._release(self._session)
+            self._session = None
+        pool.closeall()
+
+    def _checkout(self):
+        """Take a connection from the pool, waiting if all of them are in use"""
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self._slots.acquire()
+            with self._stats_lock:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += time.monotonic() - start
 
-    def init_tables(self):
-        """Create the necessary tables with pgvector support"""
-        # Enable pgvector extension
-        self.cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-
-        # Create patients table
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS patients (
-                id VARCHAR PRIMARY KEY,
-                first_name VARCHAR,
-                last_name VARCHAR,
-                gender VARCHAR,
-                birth_date DATE,
-                deceased BOOLEAN,
-                embedding vector(384),  -- 384 dimensions for all-MiniLM-L6-v2
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
+        try:
+            connection = self.pool.getconn()
+            if connection not in self._registered:
+                register_vector(connection)
+                connection.commit()
+                self._registered.add(connection)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+        return connection
+
+    def _release(self, connection):
+        # Broken connections are closed rather than handed to the next caller
+        broken = connection.closed != 0
+        with self._stats_lock:
+            self._stats["in_use"] -= 1
+            if broken:
+                self._stats["discarded"] += 1
+        if broken:
+            self._registered.discard(connection)
+        self.pool.putconn(connection, close=broken)
+        self._slots.release()
+
+    @contextmanager
+    def pooled_connection(self):
         """
-        )
-
-        # Create observations table
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS observations (
-                id VARCHAR PRIMARY KEY,
-                patient_id VARCHAR,
-                code TEXT,
-                value FLOAT,
-                unit VARCHAR,
-                date TIMESTAMP,
-                embedding vector(384),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (patient_id) REFERENCES patients(id)
-            );
+        Check out a connection for the duration of the block. The transaction
+        is committed when the block exits normally and rolled back on error.
         """
+        connection = self._checkout()
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            with self._stats_lock:
+                self._stats["rollbacks"] += 1
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            self._release(connection)
+
+    @contextmanager
+    def transaction(self):
+        """Check out a pooled connection and yield a cursor on it, see pooled_connection"""
+        with self.pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                yield cursor
+
+    def pool_stats(self) -> dict:
+        """Pool size and usage counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(
+            {
+                "min": self.min_connections,
+                "max": self.max_connections,
+                "available": self.max_connections - stats["in_use"],
+            }
         )
+        return stats
 
-        # Create conditions table
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS conditions (
-                id VARCHAR PRIMARY KEY,
-                patient_id VARCHAR,
-                code TEXT,
-                onset TIMESTAMP,
-                abatement TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (patient_id) REFERENCES patients(id)
-            );
-        """
-        )
+    def _pin_session(self):
+        if self._session is None:
+            self._session = self._checkout()
+            self._session_cursor = self._session.cursor()
 
-        self.commit_connection()
+    @property
+    def connection(self):
+        """Connection pinned to this Database, used by the save_* methods"""
+        self._pin_session()
+        return self._session
+
+    @property
+    def cursor(self):
+        self._pin_session()
+        return self._session_cursor
 
     def get_connection(self):
         return self.connection
@@ -132,160 +364,379 @@ class Database:
     def rollback_commit(self):
         self.connection.rollback()
 
-    def save_patient(self, patient: Patient) -> bool:
-        """Save patient data to database with embedding"""
+    def get_emr_summary(self, patient_id: str, fingerprint: str) -> Optional[dict]:
+        """Return the stored EMR summary if it is fresh and matches the fingerprint"""
         try:
-            patient_id = patient.id
-            first_name = (
-                patient.name[0].given[0]
-                if patient.name and patient.name[0].given
-                else ""
-            )
-            last_name = (
-                patient.name[0].family
-                if patient.name and patient.name[0].family
-                else ""
-            )
-            gender = patient.gender
-            birth_date = patient.birthDate.isostring if patient.birthDate else None
-            deceased = getattr(patient, "deceasedBoolean", None)
-
-            # Generate embedding
-            embedding = generate_patient_embedding(patient)
+            with self.transaction() as cursor:
+                cursor.execute(
+                    """
+                    SELECT summary FROM emr_summaries
+                    WHERE patient_id = %s AND fingerprint = %s AND NOT stale
+                    """,
+                    (patient_id, fingerprint),
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Error loading EMR summary for {patient_id}: {e}")
+            return None
 
-            self.cursor.execute(
-                """
-                INSERT INTO patients (id, first_name, last_name, gender, birth_date, deceased, embedding)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE SET
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name,
-                    gender = EXCLUDED.gender,
-                    birth_date = EXCLUDED.birth_date,
-                    deceased = EXCLUDED.deceased,
-                    embedding = EXCLUDED.embedding
-                """,
-                (
-                    patient_id,
-                    first_name,
-                    last_name,
-                    gender,
-                    birth_date,
-                    deceased,
-                    embedding,
-                ),
-            )
+    def save_emr_summary(self, patient_id: str, fingerprint: str, summary: dict) -> bool:
+        """Store the EMR summary for a patient, replacing any older one"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO emr_summaries (patient_id, fingerprint, summary, stale, updated_at)
+                    VALUES (%s, %s, %s, FALSE, CURRENT_TIMESTAMP)
+                    ON CONFLICT (patient_id) DO UPDATE SET
+                        fingerprint = EXCLUDED.fingerprint,
+                        summary = EXCLUDED.summary,
+                        stale = FALSE,
+                        updated_at = EXCLUDED.updated_at
+                    """,
+                    (patient_id, fingerprint, Json(summary)),
+                )
             return True
         except Exception as e:
-            print(f"Error saving patient {patient.id}: {e}")
+            print(f"Error saving EMR summary for {patient_id}: {e}")
             return False
 
-    def save_observation(self, observation: Observation) -> bool:
-        """Save observation data to database with embedding"""
-        try:
-            obs_id = observation.id
-            patient_ref = extract_patient_id(
-                observation.subject.reference.split("/")[-1]
-                if observation.subject and observation.subject.reference
-                else None
+    def mark_emr_summaries_stale(self, patient_ids: list[str]):
+        """Flag the EMR summaries of patients whose records were (re)ingested"""
+        if not patient_ids:
+            return
+        self.cursor.execute(
+            "UPDATE emr_summaries SET stale = TRUE WHERE patient_id = ANY(%s::text[])",
+            (list(patient_ids),),
+        )
+
+    def get_manifest(self, paths: list[str]) -> dict[str, tuple[int, float, str]]:
+        """Returns: {path: (size, mtime, content_hash)} for files already ingested"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                """
+                SELECT path, size, mtime, content_hash FROM ingestion_manifest
+                WHERE path = ANY(%s::text[])
+                """,
+                (list(paths),),
             )
-            code = observation.code.text if observation.code else None
+            return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
 
-            # Handle different value types
-            value = None
-            unit = None
-            if hasattr(observation, "valueQuantity") and observation.valueQuantity:
-                value = getattr(observation.valueQuantity, "value", None)
-                unit = getattr(observation.valueQuantity, "unit", None)
+    def save_manifest_entry(self, path: str, size: int, mtime: float, content_hash: str):
+        """Record a file as ingested, in the pinned connection's transaction"""
+        self.cursor.execute(
+            """
+            INSERT INTO ingestion_manifest (path, size, mtime, content_hash, ingested_at)
+            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (path) DO UPDATE SET
+                size = EXCLUDED.size,
+                mtime = EXCLUDED.mtime,
+                content_hash = EXCLUDED.content_hash,
+                ingested_at = EXCLUDED.ingested_at
+            """,
+            (path, size, mtime, content_hash),
+        )
 
-            fhirDate: FHIRDateTime | None = getattr(
-                observation, "effectiveDateTime", None
+    def get_text_hashes(self, table: str, ids: list[str]) -> dict[str, str]:
+        """Returns: {id: text_hash} for stored rows of patients or observations"""
+        if table not in ("patients", "observations"):
+            raise ValueError(f"Table {table} has no text hashes")
+        if not ids:
+            return {}
+        with self.transaction() as cursor:
+            cursor.execute(
+                f"""
+                SELECT id, text_hash FROM {table}
+                WHERE id = ANY(%s::text[]) AND text_hash IS NOT NULL AND embedding IS NOT NULL
+                """,
+                (list(ids),),
             )
-            date: str | None = (
-                fhirDate.isostring if isinstance(fhirDate, FHIRDateTime) else None
+            return dict(cursor.fetchall())
+
+    def get_embeddings_by_text_hash(self, table: str, hashes: list[str]) -> dict:
+        """
+        Returns: {text_hash: embedding} from stored rows of patients or
+        observations with those text hashes, whichever row they come from
+        """
+        if table not in ("patients", "observations"):
+            raise ValueError(f"Table {table} has no text hashes")
+        if not hashes:
+            return {}
+        with self.transaction() as cursor:
+            cursor.execute(
+                f"""
+                SELECT DISTINCT ON (text_hash) text_hash, embedding::vector FROM {table}
+                WHERE text_hash = ANY(%s::text[]) AND embedding IS NOT NULL
+                """,
+                (list(hashes),),
             )
+            return dict(cursor.fetchall())
 
-            # Generate embedding
-            embedding = generate_observation_embedding(observation)
+    def get_cached_embeddings(self, keys: list[str]) -> dict:
+        """Returns: {text_hash: embedding} for the keys in the embedding cache"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(
+                    "SELECT text_hash, embedding FROM embedding_cache WHERE text_hash = ANY(%s::text[])",
+                    (list(keys),),
+                )
+                return dict(cursor.fetchall())
+        except Exception as e:
+            print(f"Error loading cached embeddings: {e}")
+            return {}
 
-            self.cursor.execute(
+    def save_cached_embeddings(self, embeddings: dict):
+        """
+        Store {text_hash: embedding} in the embedding cache, dropping the
+        oldest entries above embedding_store_max_entries
+        """
+        if not embeddings:
+            return
+        try:
+            with self.transaction() as cursor:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO embedding_cache (text_hash, embedding) VALUES %s
+                    ON CONFLICT (text_hash) DO NOTHING
+                    """,
+                    [(key, Vector(vector)) for key, vector in embeddings.items()],
+                )
+                cursor.execute(
+                    """
+                    DELETE FROM embedding_cache WHERE text_hash IN (
+                        SELECT text_hash FROM embedding_cache
+                        ORDER BY created_at DESC
+                        OFFSET %s
+                    )
+                    """,
+                    (embedding_store_max_entries,),
+                )
+        except Exception as e:
+            print(f"Error saving cached embeddings: {e}")
+
+    def get_unembedded_observation_codes(self) -> list[str]:
+        """Distinct observation codes with no entry in the code vocabulary yet"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                """
+                SELECT DISTINCT o.code FROM observations o
+                WHERE o.code IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM observation_codes c WHERE c.code = o.code)
                 """
-                INSERT INTO observations (id, patient_id, code, value, unit, date, embedding)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE SET
-                    patient_id = EXCLUDED.patient_id,
-                    code = EXCLUDED.code,
-                    value = EXCLUDED.value,
-                    unit = EXCLUDED.unit,
-                    date = EXCLUDED.date,
-                    embedding = EXCLUDED.embedding
-                """,
-                (obs_id, patient_ref, code, value, unit, date, embedding),
             )
+            return [row[0] for row in cursor.fetchall()]
 
+    def save_observation_codes(self, embeddings: dict) -> bool:
+        """Store {code: embedding} in the code vocabulary"""
+        if not embeddings:
+            return True
+        try:
+            with self.transaction() as cursor:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO observation_codes (code, embedding) VALUES %s
+                    ON CONFLICT (code) DO NOTHING
+                    """,
+                    [(code, Vector(vector)) for code, vector in embeddings.items()],
+                )
             return True
         except Exception as e:
-            print(f"Error saving observation {observation.id}: {e}")
+            print(f"Error saving observation codes: {e}")
             return False
 
-    def save_condition(self, condition: Condition) -> bool:
-        """Save condition data to database"""
-        try:
-            cond_id = condition.id
-            patient_ref = extract_patient_id(
-                condition.subject.reference.split("/")[-1]
-                if condition.subject and condition.subject.reference
-                else None
-            )
-            code = condition.code.text if condition.code else None
-            onset_fhir: FHIRDateTime | None = getattr(condition, "onsetDateTime", None)
-            onset = (
-                onset_fhir.isostring if isinstance(onset_fhir, FHIRDateTime) else None
-            )
-            abatement_fhir: FHIRDateTime | None = getattr(
-                condition, "abatementDateTime", None
-            )
-            abatement = (
-                abatement_fhir.isostring
-                if isinstance(abatement_fhir, FHIRDateTime)
-                else None
+    def refresh_clinical_embeddings(self, patient_ids: list[str]):
+        """
+        Recompute the clinical embedding of patients from their condition and
+        observation embeddings, in the pinned connection's transaction. Each
+        kind of observation counts once, so frequent vitals don't drown out
+        the rest. Patients without any embedded records are left unchanged.
+        """
+        if not patient_ids:
+            return
+        patient_ids = list(patient_ids)
+        self.cursor.execute(
+            """
+            UPDATE patients p
+            SET clinical_embedding = aggregated.embedding
+            FROM (
+                SELECT patient_id, AVG(embedding) AS embedding
+                FROM (
+                    SELECT patient_id, embedding FROM conditions
+                    WHERE patient_id = ANY(%s::text[]) AND embedding IS NOT NULL
+                    UNION ALL
+                    SELECT patient_id, AVG(embedding::vector) FROM observations
+                    WHERE patient_id = ANY(%s::text[]) AND embedding IS NOT NULL
+                    GROUP BY patient_id, code
+                ) records
+                GROUP BY patient_id
+            ) aggregated
+            WHERE p.id = aggregated.patient_id
+            """,
+            (patient_ids, patient_ids),
+        )
+
+    def get_unembedded_condition_codes(self) -> list[str]:
+        """Distinct codes of conditions stored before conditions were embedded"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT code FROM conditions WHERE embedding IS NULL AND code IS NOT NULL"
             )
+            return [row[0] for row in cursor.fetchall()]
 
-            self.cursor.execute(
+    def save_condition_embeddings(self, embeddings: dict) -> set[str]:
+        """
+        Set {code: embedding} on the conditions with that code and no
+        embedding, in the pinned connection's transaction.
+        Returns: ids of the patients whose conditions were updated
+        """
+        if not embeddings:
+            return set()
+        rows = execute_values(
+            self.cursor,
+            """
+            UPDATE conditions c SET embedding = v.embedding
+            FROM (VALUES %s) AS v(code, embedding)
+            WHERE c.code = v.code AND c.embedding IS NULL
+            RETURNING c.patient_id
+            """,
+            [(code, Vector(vector)) for code, vector in embeddings.items()],
+            template="(%s, %s::vector)",
+            fetch=True,
+        )
+        return {row[0] for row in rows if row[0]}
+
+    def get_patients_without_clinical_embedding(self) -> list[str]:
+        """Patients with embedded records but no clinical embedding yet"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                """
+                SELECT p.id FROM patients p
+                WHERE p.clinical_embedding IS NULL
+                AND (
+                    EXISTS (
+                        SELECT 1 FROM conditions c
+                        WHERE c.patient_id = p.id AND c.embedding IS NOT NULL
+                    )
+                    OR EXISTS (
+                        SELECT 1 FROM observations o
+                        WHERE o.patient_id = p.id AND o.embedding IS NOT NULL
+                    )
+                )
                 """
-                INSERT INTO conditions (id, patient_id, code, onset, abatement)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE SET
-                    patient_id = EXCLUDED.patient_id,
-                    code = EXCLUDED.code,
-                    onset = EXCLUDED.onset,
-                    abatement = EXCLUDED.abatement
-                """,
-                (cond_id, patient_ref, code, onset, abatement),
             )
+            return [row[0] for row in cursor.fetchall()]
 
-            return True
-        except Exception as e:
-            print(f"Error saving condition {condition.id}: {e}")
-            return False
+    def upsert_patients(self, rows: list[dict], page_size: int = 1000) -> "BulkWriteResult":
+        """Bulk insert or update patient rows (see fhir_stream.patient_row), embeddings included"""
+        return self._bulk_upsert("patients", PATIENT_COLUMNS, rows, page_size)
+
+    def upsert_observations(self, rows: list[dict], page_size: int = 1000) -> "BulkWriteResult":
+        """Bulk insert or update observation rows (see fhir_stream.observation_row), embeddings included"""
+        return self._bulk_upsert("observations", OBSERVATION_COLUMNS, rows, page_size)
+
+    def upsert_conditions(self, rows: list[dict], page_size: int = 1000) -> "BulkWriteResult":
+        """Bulk insert or update condition rows (see fhir_stream.condition_row), embeddings included"""
+        return self._bulk_upsert("conditions", CONDITION_COLUMNS, rows, page_size)
+
+    def _bulk_upsert(
+        self, table: str, columns: tuple[str, ...], rows: list[dict], page_size: int
+    ) -> "BulkWriteResult":
+        """
+        Upsert rows with one multi-row INSERT ... ON CONFLICT per batch of
+        page_size rows, inside the pinned connection's transaction (the caller
+        commits). Each batch runs under its own savepoint, so a failing batch
+        is rolled back and reported without losing the batches around it.
+        """
+        result = BulkWriteResult(table)
+
+        # A single statement can't update the same row twice, keep the last copy
+        unique_rows = list({row["id"]: row for row in rows}.values())
+
+        sql = upsert_sql(table, columns, multi_row=True)
+        for start in range(0, len(unique_rows), page_size):
+            batch = unique_rows[start : start + page_size]
+            self.cursor.execute("SAVEPOINT bulk_upsert")
+            try:
+                execute_values(
+                    self.cursor,
+                    sql,
+                    [row_values(row, columns) for row in batch],
+                    page_size=page_size,
+                )
+                self.cursor.execute("RELEASE SAVEPOINT bulk_upsert")
+                result.written += len(batch)
+            except Exception as e:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_upsert")
+                result.failed.append(([row["id"] for row in batch], str(e)))
+                print(f"Error saving {len(batch)} rows into {table}: {e}")
+
+        return result
+
+    @staticmethod
+    def set_search_params(
+        cursor,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        exact: bool = False,
+    ):
+        """
+        Tune the embedding index scans of the current transaction. Higher
+        ef_search (HNSW) or probes (IVFFlat) find more of the true nearest
+        neighbours at the cost of latency. exact skips the indexes entirely.
+        """
+        ef_search = ef_search or default_ef_search
+        probes = probes or default_probes
+        if ef_search:
+            cursor.execute("SET LOCAL hnsw.ef_search = %s;", (int(ef_search),))
+        if probes:
+            cursor.execute("SET LOCAL ivfflat.probes = %s;", (int(probes),))
+        if exact:
+            cursor.execute("SET LOCAL enable_indexscan = off;")
 
     def find_similar_patients(
-        self, patient_id: str, limit: int = 5
+        self,
+        patient_id: str,
+        limit: int = 5,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        column: str | None = None,
     ) -> list[tuple[str, float]]:
-        """Find similar patients based on embedding similarity"""
+        """
+        Find similar patients based on embedding similarity, of the
+        clinical_embedding or (demographic) embedding column, see
+        PATIENT_SIMILARITY
+        """
+        column = column or patient_embedding_column()
         try:
-            self.cursor.execute(
-                """
-                SELECT p2.id, p2.first_name, p2.last_name, 
-                       1 - (p1.embedding <=> p2.embedding) as similarity
-                FROM patients p1, patients p2
-                WHERE p1.id = %s AND p2.id != %s AND p1.embedding IS NOT NULL AND p2.embedding IS NOT NULL
-                ORDER BY p1.embedding <=> p2.embedding
-                LIMIT %s
-                """,
-                (patient_id, patient_id, limit),
-            )
-            return self.cursor.fetchall()
+            with self.transaction() as cursor:
+                self.set_search_params(cursor, ef_search, probes)
+                # The target embedding is a subquery constant, so the scan can
+                # use the embedding index instead of comparing every pair
+                cursor.execute(
+                    f"""
+                    WITH target AS (
+                        SELECT {column} AS embedding FROM patients WHERE id = %s
+                    )
+                    SELECT id, first_name, last_name, similarity
+                    FROM (
+                        SELECT p.id, p.first_name, p.last_name,
+                               1 - (p.{column} <=> (SELECT embedding FROM target)) AS similarity
+                        FROM patients p
+                        WHERE p.{column} IS NOT NULL
+                          AND (SELECT embedding FROM target) IS NOT NULL
+                        ORDER BY p.{column} <=> (SELECT embedding FROM target)
+                        LIMIT %s
+                    ) nearest
+                    WHERE id != %s
+                    ORDER BY similarity DESC
+                    LIMIT %s
+                    """,
+                    (patient_id, limit + 1, patient_id, limit),
+                )
+                return cursor.fetchall()
         except Exception as e:
             print(f"Error finding similar patients: {e}")
             return []
@@ -295,11 +746,15 @@ class Database:
         target_patient_id: str,
         candidate_patient_ids: list[str],
         limit: int = 5,
+        column: str | None = None,
     ) -> list[tuple[str, float]]:
         """
         Rank the given candidate patients by pgvector similarity to the target patient.
+        Compares clinical embeddings by default (see PATIENT_SIMILARITY), falling
+        back to demographic ones while the target has no clinical embedding.
         Returns: [(patient_id, similarity), ...] in descending similarity.
         """
+        column = column or patient_embedding_column()
         try:
             if not candidate_patient_ids:
                 return []
@@ -309,47 +764,222 @@ class Database:
             if not candidate_patient_ids:
                 return []
 
-            sql = """
+            sql = f"""
                 SELECT
                 p2.id,
-                1 - (p1.embedding <=> p2.embedding) AS similarity
+                1 - (p1.{column} <=> p2.{column}) AS similarity
                 FROM patients p1
                 JOIN patients p2
                 ON p2.id = ANY(%s::text[])
                 WHERE p1.id = %s
                 AND p2.id <> p1.id
-                AND p1.embedding IS NOT NULL
-                AND p2.embedding IS NOT NULL
-                ORDER BY p1.embedding <=> p2.embedding
+                AND p1.{column} IS NOT NULL
+                AND p2.{column} IS NOT NULL
+                ORDER BY p1.{column} <=> p2.{column}
                 LIMIT %s
             """
-            self.cursor.execute(sql, (candidate_patient_ids, target_patient_id, limit))
-            return self.cursor.fetchall()  # -> [(id, similarity), ...]
+            with self.transaction() as cursor:
+                cursor.execute(sql, (candidate_patient_ids, target_patient_id, limit))
+                results = cursor.fetchall()  # -> [(id, similarity), ...]
+
+            if not results and column == "clinical_embedding":
+                return self.find_similar_patients_from_list(
+                    target_patient_id, candidate_patient_ids, limit, column="embedding"
+                )
+            return results
         except Exception as e:
             print(f"Error finding similar patients from list: {e}")
             return []
             
     def find_similar_observations(
-        self, observation_text: str, limit: int = 5
+        self,
+        observation_text: str,
+        limit: int = 5,
+        ef_search: int | None = None,
+        probes: int | None = None,
     ) -> list[tuple[str, str, float]]:
         """Find similar observations based on text similarity"""
-        try:
-            # Generate embedding for the query text
-            query_embedding = embedding_model.encode(observation_text).tolist()
-            vect = Vector(query_embedding)
+        return self.find_similar_observations_batch(
+            [observation_text], limit, ef_search, probes
+        )[0]
 
-            self.cursor.execute(
-                """
-                SELECT patient_id, code, 1 - (embedding <=> %s) as similarity
-                FROM observations
-                WHERE embedding IS NOT NULL
-                ORDER BY embedding <=> %s
-                LIMIT %s
-                """,
-                (vect, vect, limit),
-            )
-            return self.cursor.fetchall()
+    def find_similar_observations_batch(
+        self,
+        observation_texts: list[str],
+        limit: int = 5,
+        ef_search: int | None = None,
+        probes: int | None = None,
+    ) -> list[list[tuple[str, str, float]]]:
+        """
+        Find similar observations for many query texts at once. All texts are
+        embedded in one batch and searched with a single SQL statement.
+        Returns: one [(patient_id, code, similarity), ...] list per query text
+        """
+        if not observation_texts:
+            return []
+
+        try:
+            query_embeddings = self.embedding_cache.encode(observation_texts)
+            # Sent as text and cast server side, one row per query text
+            vectors = [
+                "[" + ",".join(str(float(x)) for x in embedding) + "]"
+                for embedding in query_embeddings
+            ]
+
+            with self.transaction() as cursor:
+                self.set_search_params(cursor, ef_search, probes)
+                cursor.execute(
+                    f"""
+                    SELECT q.idx, o.patient_id, o.code, o.similarity
+                    FROM unnest(%s::text[]) WITH ORDINALITY AS q(embedding, idx)
+                    CROSS JOIN LATERAL ({nearest_observations_sql()}) o
+                    ORDER BY q.idx, o.similarity DESC
+                    """,
+                    (vectors, *nearest_observations_params(limit)),
+                )
+                rows = cursor.fetchall()
+
+            results = [[] for _ in observation_texts]
+            for idx, patient_id, code, similarity in rows:
+                results[idx - 1].append((patient_id, code, similarity))
+            return results
         except Exception as e:
             print(f"Error finding similar observations: {e}")
-            self.rollback_commit()
+            return [[] for _ in observation_texts]
+
+    def find_similar_patients_by_observation(
+        self,
+        observation_texts: list[str],
+        limit: int = 5,
+        candidates: int | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+    ) -> list[list[tuple[str, str, float]]]:
+        """
+        The limit most similar distinct patients for each query text, each
+        with the code and similarity of their best matching observation.
+        Patients are picked from the candidates (default limit *
+        PATIENT_CANDIDATE_FACTOR) nearest observations, in one statement.
+        Returns: one [(patient_id, code, similarity), ...] list per query text
+        """
+        if not observation_texts:
             return []
+
+        try:
+            query_embeddings = self.embedding_cache.encode(observation_texts)
+            vectors = [
+                "[" + ",".join(str(float(x)) for x in embedding) + "]"
+                for embedding in query_embeddings
+            ]
+            candidates = candidates or limit * patient_candidate_factor
+
+            with self.transaction() as cursor:
+                # An HNSW scan returns at most ef_search rows, it has to cover the candidates
+                scanned = nearest_observations_params(candidates)[0]
+                self.set_search_params(
+                    cursor, max(ef_search or int(default_ef_search or 40), scanned), probes
+                )
+                cursor.execute(
+                    f"""
+                    SELECT q.idx, best.patient_id, best.code, best.similarity
+                    FROM unnest(%s::text[]) WITH ORDINALITY AS q(embedding, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT patient_id, code, similarity
+                        FROM (
+                            SELECT DISTINCT ON (patient_id) patient_id, code, similarity
+                            FROM ({nearest_observations_sql()}) candidates
+                            WHERE patient_id IS NOT NULL
+                            ORDER BY patient_id, similarity DESC
+                        ) per_patient
+                        ORDER BY similarity DESC
+                        LIMIT %s
+                    ) best
+                    ORDER BY q.idx, best.similarity DESC
+                    """,
+                    (vectors, *nearest_observations_params(candidates), limit),
+                )
+                rows = cursor.fetchall()
+
+            results = [[] for _ in observation_texts]
+            for idx, patient_id, code, similarity in rows:
+                results[idx - 1].append((patient_id, code, similarity))
+            return results
+        except Exception as e:
+            print(f"Error finding similar patients by observation: {e}")
+            return [[] for _ in observation_texts]
+
+    def find_similar_observations_by_code(
+        self,
+        observation_texts: list[str],
+        limit: int = 5,
+        candidates: int | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        distinct_patients: bool = False,
+    ) -> list[list[tuple[str, str, float]]]:
+        """
+        Same results as find_similar_observations_batch, found through the code
+        vocabulary: the nearest codes to each query text, then observations
+        with those codes, most similar code and most recent first. Searches a
+        few thousand codes instead of every observation, but ignores values.
+        With distinct_patients, returns the limit best distinct patients
+        instead, each with the code of their best matching observation.
+        Returns: one [(patient_id, code, similarity), ...] list per query text
+        """
+        if not observation_texts:
+            return []
+
+        try:
+            query_embeddings = self.embedding_cache.encode(observation_texts)
+            vectors = [
+                "[" + ",".join(str(float(x)) for x in embedding) + "]"
+                for embedding in query_embeddings
+            ]
+
+            with self.transaction() as cursor:
+                self.set_search_params(cursor, ef_search, probes)
+                # Grouping by patient reads more observations per code, so
+                # enough distinct patients remain after keeping one row each
+                group_key = "o.patient_id" if distinct_patients else "o.id"
+                per_code = limit * patient_candidate_factor if distinct_patients else limit
+                cursor.execute(
+                    f"""
+                    SELECT idx, patient_id, code, similarity
+                    FROM (
+                        SELECT idx, patient_id, code, similarity,
+                               row_number() OVER (
+                                   PARTITION BY idx ORDER BY similarity DESC, date DESC NULLS LAST
+                               ) AS rank
+                        FROM (
+                            SELECT DISTINCT ON (q.idx, {group_key})
+                                   q.idx, o.patient_id, c.code, c.similarity, o.date
+                            FROM unnest(%s::text[]) WITH ORDINALITY AS q(embedding, idx)
+                            CROSS JOIN LATERAL (
+                                SELECT code, 1 - (embedding <=> q.embedding::vector) AS similarity
+                                FROM observation_codes
+                                ORDER BY embedding <=> q.embedding::vector
+                                LIMIT %s
+                            ) c
+                            CROSS JOIN LATERAL (
+                                SELECT id, patient_id, date FROM observations
+                                WHERE code = c.code AND patient_id IS NOT NULL
+                                ORDER BY date DESC NULLS LAST
+                                LIMIT %s
+                            ) o
+                            ORDER BY q.idx, {group_key}, c.similarity DESC, o.date DESC NULLS LAST
+                        ) matches
+                    ) ranked
+                    WHERE rank <= %s
+                    ORDER BY idx, rank
+                    """,
+                    (vectors, candidates or code_candidates, per_code, limit),
+                )
+                rows = cursor.fetchall()
+
+            results = [[] for _ in observation_texts]
+            for idx, patient_id, code, similarity in rows:
+                results[idx - 1].append((patient_id, code, similarity))
+            return results
+        except Exception as e:
+            print(f"Error finding similar observations by code: {e}")
+            return [[] for _ in observation_texts]
@@ -0,0 +1,112 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DIMENSION = 384
+
+# int8 quantized export published alongside the model on the Hugging Face hub.
+# The avx2 build runs on any recent x86 CPU; use onnx/model_qint8_avx512.onnx
+# or onnx/model_qint8_arm64.onnx where those instruction sets are available
+DEFAULT_QUANTIZED_FILE = "onnx/model_quint8_avx2.onnx"
+
+
+class EmbeddingBackend(ABC):
+    """
+    A sentence embedding model. encode() follows SentenceTransformer.encode:
+    a string gives one vector, a list of strings gives a 2D array.
+    The model (and torch or onnxruntime) is only loaded on first use.
+    """
+
+    name = "base"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def load(self):
+        """Build the SentenceTransformer, imported here so it stays unloaded until needed"""
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        # Threads embedding at the same time wait for one load instead of each loading
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self.load()
+        return self._model
+
+    @property
+    def id(self) -> str:
+        """Identifies the vectors this backend produces, e.g. for cache keys"""
+        return f"{self.model_name}/{self.name}"
+
+    def encode(self, texts, batch_size: int = 32):
+        return self.model.encode(texts, batch_size=batch_size)
+
+
+class TorchBackend(EmbeddingBackend):
+    """The model in PyTorch, full float32 precision"""
+
+    name = "torch"
+
+    def load(self):
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(self.model_name, device="cpu")
+
+
+class OnnxBackend(EmbeddingBackend):
+    """The model exported to ONNX Runtime, optionally int8 quantized"""
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL_NAME,
+        quantized: bool = False,
+        file_name: str | None = None,
+    ):
+        self.quantized = quantized
+        self.file_name = file_name or (
+            os.environ.get("EMBEDDING_ONNX_FILE", DEFAULT_QUANTIZED_FILE)
+            if quantized
+            else "onnx/model.onnx"
+        )
+        self.name = "onnx-int8" if quantized else "onnx"
+        super().__init__(model_name)
+
+    def load(self):
+        from sentence_transformers import SentenceTransformer
+
+        # Needs the onnx extra, see requirements-onnx.txt
+        return SentenceTransformer(
+            self.model_name,
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"file_name": self.file_name},
+        )
+
+
+BACKENDS = {
+    "torch": lambda: TorchBackend(),
+    "onnx": lambda: OnnxBackend(),
+    "onnx-int8": lambda: OnnxBackend(quantized=True),
+}
+
+
+def load_backend(name: str | None = None) -> EmbeddingBackend:
+    """
+    The backend named by name, or the EMBEDDING_BACKEND env variable (default
+    torch). Cheap, the model itself is loaded on first encode
+    """
+    name = name or os.environ.get("EMBEDDING_BACKEND", "torch")
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {name}, expected one of {', '.join(BACKENDS)}"
+        )
+    return BACKENDS[name]()
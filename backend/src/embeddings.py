@@ -1,110 +1,132 @@
-from fhirclient.models.observation import Observation
-from fhirclient.models.patient import Patient
-from sentence_transformers import SentenceTransformer
-
-# Initialize the embedding model
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-
-
-def generate_patient_embedding(patient: Patient) -> list[float]:
-    """Generate embedding for patient demographic data"""
-    patient_text_parts = []
-
-    # Basic info
-    if patient.gender:
-        patient_text_parts.append(f"Gender: {patient.gender}")
-
-    if patient.birthDate:
-        patient_text_parts.append(f"Birth date: {patient.birthDate}")
-
-    if hasattr(patient, "deceasedBoolean") and patient.deceasedBoolean is not None:
-        status = "deceased" if patient.deceasedBoolean else "alive"
-        patient_text_parts.append(f"Status: {status}")
-
-    # Name
-    if patient.name:
-        names = []
-        for n in patient.name:
-            full_name = (
-                " ".join(n.prefix or [])
-                + " "
-                + " ".join(n.given or [])
-                + " "
-                + (n.family or "")
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from fhir.resources.observation import Observation
+
+from .embedding_backends import load_backend
+
+# The embedding model, with the backend chosen by EMBEDDING_BACKEND. Nothing
+# is loaded until the first text is embedded, or warm_up() is called
+embedding_model = load_backend()
+
+
+def warm_up():
+    """Load the model and run one forward pass, so the first request doesn't pay for it"""
+    embedding_model.encode(["warm up"])
+
+
+def model_ready() -> bool:
+    return embedding_model.loaded
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace, which doesn't change what the model sees"""
+    return " ".join(text.split())
+
+
+def embedding_key(text: str) -> str:
+    """Content address of a text's embedding, for this model and backend"""
+    return hashlib.sha256(
+        f"{embedding_model.id}\0{normalize_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embeddings (text hash -> vector) so each distinct text is
+    encoded once. Recently used vectors are kept in an in-memory LRU in front
+    of an optional persistent store, any object with
+    get_cached_embeddings(keys) -> {key: vector} and
+    save_cached_embeddings({key: vector}) (see db.Database).
+    Safe to share between threads, the LRU and counters are guarded by lock.
+    """
+
+    def __init__(self, store=None, max_entries: int | None = None):
+        self.store = store
+        self.max_entries = max_entries or int(
+            os.environ.get("EMBEDDING_CACHE_SIZE", 20000)
+        )
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, vector):
+        with self.lock:
+            self.entries[key] = np.asarray(vector, dtype=np.float32)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def encode(
+        self, texts: list[str], batch_size: int = 256, use_store: bool = True
+    ) -> list[np.ndarray]:
+        """
+        Embeddings of texts in batched forward passes, only encoding texts
+        that were never seen before. Vectors are float32 arrays, which the
+        pgvector adapters store as they are. Ingestion passes use_store=False, its
+        vectors are stored on the rows themselves and mostly unique, so they
+        only go through the in-memory LRU.
+        """
+        if not texts:
+            return []
+
+        keys = [embedding_key(text) for text in texts]
+        vectors = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    vectors[key] = self.entries[key]
+                    self.entries.move_to_end(key)
+            self.hits += sum(1 for key in keys if key in vectors)
+
+        missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+        store = self.store if use_store else None
+        if missing and store is not None:
+            stored = store.get_cached_embeddings(missing)
+            with self.lock:
+                self.store_hits += len(stored)
+            for key, vector in stored.items():
+                vectors[key] = vector
+                self._remember(key, vector)
+            missing = [key for key in missing if key not in vectors]
+
+        if missing:
+            with self.lock:
+                self.misses += len(missing)
+            texts_by_key = {key: normalize_text(text) for key, text in zip(keys, texts)}
+            new_vectors = embedding_model.encode(
+                [texts_by_key[key] for key in missing], batch_size=batch_size
             )
-            names.append(full_name.strip())
-        patient_text_parts.append(f"Name(s): {', '.join(names)}")
-
-    # Race and Ethnicity
-    if patient.extension:
-        for ext in patient.extension:
-            if "race" in ext.url.lower():
-                text = next(
-                    (e.valueString for e in ext.extension if hasattr(e, "valueString")),
-                    None,
-                )
-                if text:
-                    patient_text_parts.append(f"Race: {text}")
-            if "ethnicity" in ext.url.lower():
-                text = next(
-                    (e.valueString for e in ext.extension if hasattr(e, "valueString")),
-                    None,
-                )
-                if text:
-                    patient_text_parts.append(f"Ethnicity: {text}")
-            if "birthsex" in ext.url.lower():
-                if hasattr(ext, "valueCode"):
-                    patient_text_parts.append(f"Birth sex: {ext.valueCode}")
-            if "birthplace" in ext.url.lower() and hasattr(ext, "valueAddress"):
-                addr = ext.valueAddress
-                parts = [addr.city, addr.state, addr.country]
-                patient_text_parts.append(
-                    f"Birthplace: {', '.join(filter(None, parts))}"
-                )
-
-    # Marital status
-    if hasattr(patient, "maritalStatus") and patient.maritalStatus:
-        text = getattr(patient.maritalStatus, "text", None)
-        if text:
-            patient_text_parts.append(f"Marital status: {text}")
-
-    # Multiple birth
-    if (
-        hasattr(patient, "multipleBirthBoolean")
-        and patient.multipleBirthBoolean is not None
-    ):
-        patient_text_parts.append(f"Multiple birth: {patient.multipleBirthBoolean}")
-
-    # Communication / languages
-    if hasattr(patient, "communication") and patient.communication:
-        languages = [
-            c.language.text
-            for c in patient.communication
-            if hasattr(c.language, "text")
-        ]
-        if languages:
-            patient_text_parts.append(f"Languages: {', '.join(languages)}")
-
-    # Combine all patient information
-    patient_text = (
-        " | ".join(patient_text_parts) if patient_text_parts else "Unknown patient"
-    )
-
-    # Generate embedding
-    embedding = embedding_model.encode(patient_text)
-    return embedding.tolist()
-
-
-def generate_observation_embedding(observation: Observation) -> list[float]:
-    """Generate embedding for observation data"""
-    obs_text = observation_to_string(observation)
-
-    # Generate embedding
-    embedding = embedding_model.encode(obs_text)
-    return embedding.tolist()
+            new_vectors = dict(zip(missing, new_vectors))
+            if store is not None:
+                store.save_cached_embeddings(new_vectors)
+            for key, vector in new_vectors.items():
+                vectors[key] = vector
+                self._remember(key, vector)
+
+        # Arrays rather than lists of Python floats, about 8 times smaller
+        return [np.asarray(vectors[key], dtype=np.float32) for key in keys]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
+
 
 def observation_to_string(observation: Observation) -> str:
-    """Converts an Observation data type into a string"""
+    """
+    Converts an Observation data type into a string, the same text
+    fhir_stream.observation_to_string builds for stored observations
+    """
     # Create a text representation of observation data
     obs_text_parts = []
 
@@ -126,8 +148,31 @@ def observation_to_string(observation: Observation) -> str:
         obs_text_parts.append(f"Value: {observation.valueBoolean}")
 
     if hasattr(observation, "effectiveDateTime") and observation.effectiveDateTime:
-        obs_text_parts.append(f"Date: {observation.effectiveDateTime}")
+        obs_text_parts.append(f"Date: {date_to_string(observation.effectiveDateTime)}")
 
     # Combine all observation information
     obs_text = " | ".join(obs_text_parts) if obs_text_parts else "Unknown observation"
     return obs_text
+
+
+def condition_code_to_string(code: str) -> str:
+    """Text embedded for a condition, which is only described by its code"""
+    return f"Condition: {code}"
+
+
+def code_to_string(code: str) -> str:
+    """Text embedded for an observation code, an observation without value or date"""
+    return f"Observation: {code}"
+
+
+def date_to_string(value) -> str:
+    """ISO text of a FHIR date or dateTime, parsed into a date/datetime by fhir.resources"""
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def text_hash(text: str) -> str:
+    """
+    Hash of the text an embedding was generated from and the model and
+    backend that generated it, so switching EMBEDDING_BACKEND re-embeds rows
+    """
+    return hashlib.sha256(f"{embedding_model.id}\0{text}".encode("utf-8")).hexdigest()
@@ -0,0 +1,147 @@
+import os
+from datetime import date, datetime
+
+from .db import Database
+
+# Number of most recent observations loaded with a patient's records, the ones
+# their EMR summary is written from
+recent_observations = int(os.environ.get("RECENT_OBSERVATIONS", 10))
+
+# A patient with their conditions and most recent observations in one
+# statement. The child rows are aggregated server side into JSON arrays, one
+# result row per patient. Takes the observation limit (NULL for all) first
+EMR_QUERY = """
+    SELECT
+        p.id, p.first_name, p.last_name, p.gender, p.birth_date, p.deceased,
+        COALESCE(
+            (
+                SELECT json_agg(json_build_object(
+                    'id', c.id, 'code', c.code, 'onset', c.onset, 'abatement', c.abatement
+                ))
+                FROM conditions c
+                WHERE c.patient_id = p.id
+            ),
+            '[]'
+        ) AS conditions,
+        COALESCE(
+            (
+                SELECT json_agg(json_build_object(
+                    'id', o.id, 'code', o.code, 'value', o.value, 'unit', o.unit, 'date', o.date
+                ) ORDER BY o.date DESC NULLS LAST)
+                FROM (
+                    -- Served by observations_patient_date_idx
+                    SELECT id, code, value, unit, date
+                    FROM observations
+                    WHERE patient_id = p.id
+                    ORDER BY date DESC NULLS LAST
+                    LIMIT %s
+                ) o
+            ),
+            '[]'
+        ) AS observations
+    FROM patients p
+"""
+
+
+def get_patient_records(
+    db: Database,
+    patient_id: str,
+    first_name: str | None = None,
+    last_name: str | None = None,
+    observation_limit: int | None = recent_observations,
+) -> dict | None:
+    """
+    A patient's demographics, conditions and their observation_limit most
+    recent observations (newest first, None for all) in one round trip,
+    optionally only if the name matches.
+    Returns: records dict (see patient_records), or None if not found
+    """
+    query = EMR_QUERY + " WHERE p.id = %s"
+    params = [observation_limit, patient_id]
+
+    if first_name:
+        query += " AND p.first_name = %s"
+        params.append(first_name)
+    if last_name:
+        query += " AND p.last_name = %s"
+        params.append(last_name)
+
+    with db.transaction() as cursor:
+        cursor.execute(query, tuple(params))
+        row = cursor.fetchone()
+    return patient_records(row) if row else None
+
+
+def get_patient_records_many(
+    db: Database,
+    patient_ids: list[str],
+    observation_limit: int | None = recent_observations,
+) -> dict[str, dict]:
+    """
+    Records of several patients in one round trip, see get_patient_records.
+    Returns: {patient_id: records} for the patients that exist
+    """
+    if not patient_ids:
+        return {}
+
+    with db.transaction() as cursor:
+        cursor.execute(
+            EMR_QUERY + " WHERE p.id = ANY(%s::text[])",
+            (observation_limit, list(patient_ids)),
+        )
+        rows = cursor.fetchall()
+    return {str(row[0]): patient_records(row) for row in rows}
+
+
+def patient_records(row: tuple) -> dict:
+    """Build the records dict of one EMR_QUERY row"""
+    patient_id, first_name, last_name, gender, birth_date, deceased, conditions, observations = row
+
+    # Calculate age
+    age = None
+    if birth_date:
+        today = date.today()
+        age = (
+            today.year
+            - birth_date.year
+            - ((today.month, today.day) < (birth_date.month, birth_date.day))
+        )
+
+    # JSON carries timestamps as ISO text and floats as numbers, they are
+    # converted back so the strings match what the columns themselves give
+    conditions_list = [
+        {
+            "id": str(c["id"]),
+            "code": str(c["code"]),
+            "onset": timestamp_string(c["onset"]),
+            "abatement": timestamp_string(c["abatement"]),
+        }
+        for c in conditions
+    ]
+
+    observations_list = [
+        {
+            "id": str(o["id"]),
+            "code": str(o["code"]),
+            "value": str(float(o["value"])) if o["value"] is not None else None,
+            "unit": str(o["unit"]) if o["unit"] is not None else None,
+            "date": timestamp_string(o["date"]),
+        }
+        for o in observations
+    ]
+
+    return {
+        "id": str(patient_id),
+        "first_name": str(first_name),
+        "last_name": str(last_name),
+        "gender": str(gender) if gender else "unknown",
+        "age": age,
+        "deceased": deceased,
+        "conditions": conditions_list,
+        "observations": observations_list,
+    }
+
+
+def timestamp_string(value: str | None) -> str | None:
+    """str() of the timestamp a JSON ISO string came from"""
+    return str(datetime.fromisoformat(value)) if value else None
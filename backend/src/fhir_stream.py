@@ -0,0 +1,229 @@
+from datetime import date, datetime
+from typing import Iterator, Optional
+
+import ijson
+
+from .db import extract_patient_id
+from .embeddings import condition_code_to_string
+
+# Row records and embedding texts of FHIR bundle resources, built from the raw
+# JSON of one resource at a time. These are the only builders of stored rows,
+# text hashes are computed from the texts produced here.
+
+
+def iter_resources(file: str) -> Iterator[dict]:
+    """Yield the resources of a FHIR bundle file one entry at a time"""
+    with open(file, "rb") as f:
+        for resource in ijson.items(f, "entry.item.resource", use_float=True):
+            if resource:
+                yield resource
+
+
+def iter_bundle_rows(file: str) -> Iterator[tuple[str, dict]]:
+    """
+    Yield ("Patient" | "Observation" | "Condition", row) for a bundle file,
+    with the embedding source text under "text" (None for conditions without
+    a code).
+    Rows are yielded after the patient they reference. Records of patients
+    that are not in the file (already stored) are yielded at the end.
+    """
+    seen_patients = set()
+    # Records waiting for their patient, keyed by patient id
+    waiting: dict[str, list[tuple[str, dict]]] = {}
+
+    for resource in iter_resources(file):
+        rtype = resource.get("resourceType")
+        if rtype == "Patient":
+            row = patient_row(resource)
+            row["text"] = patient_to_string(resource)
+            yield rtype, row
+
+            seen_patients.add(row["id"])
+            yield from waiting.pop(row["id"], [])
+            continue
+
+        if rtype == "Observation":
+            row = observation_row(resource)
+            row["text"] = observation_to_string(resource)
+        elif rtype == "Condition":
+            row = condition_row(resource)
+            row["text"] = condition_code_to_string(row["code"]) if row["code"] else None
+        else:
+            continue
+
+        if row["patient_id"] and row["patient_id"] not in seen_patients:
+            waiting.setdefault(row["patient_id"], []).append((rtype, row))
+        else:
+            yield rtype, row
+
+    for records in waiting.values():
+        yield from records
+
+
+def iso_date(value: Optional[str], with_time: bool = False) -> Optional[str]:
+    """
+    Normalize a FHIR date (or dateTime, with_time=True) the way fhirclient's
+    FHIRDate/FHIRDateTime isostring did, so rows and text hashes stored by
+    earlier ingestions stay unchanged
+    """
+    if not value:
+        return None
+    if "T" in value:
+        return datetime.fromisoformat(value).isoformat()
+
+    # Partial dates (YYYY, YYYY-MM) are expanded to the first day
+    parts = value.split("-") + ["01", "01"]
+    day = date(int(parts[0]), int(parts[1]), int(parts[2]))
+    if with_time:
+        return datetime(day.year, day.month, day.day).isoformat()
+    return day.isoformat()
+
+
+def subject_patient_id(resource: dict) -> Optional[str]:
+    reference = (resource.get("subject") or {}).get("reference")
+    return extract_patient_id(reference.split("/")[-1] if reference else None)
+
+
+def patient_row(patient: dict) -> dict:
+    """Patient columns, without the embedding"""
+    names = patient.get("name") or []
+    given = names[0].get("given") if names else None
+    family = names[0].get("family") if names else None
+
+    return {
+        "id": patient.get("id"),
+        "first_name": given[0] if given else "",
+        "last_name": family or "",
+        "gender": patient.get("gender"),
+        "birth_date": iso_date(patient.get("birthDate")),
+        "deceased": patient.get("deceasedBoolean"),
+    }
+
+
+def observation_row(observation: dict) -> dict:
+    """Observation columns, without the embedding"""
+    quantity = observation.get("valueQuantity") or {}
+
+    return {
+        "id": observation.get("id"),
+        "patient_id": subject_patient_id(observation),
+        "code": (observation.get("code") or {}).get("text"),
+        "value": quantity.get("value"),
+        "unit": quantity.get("unit"),
+        "date": iso_date(observation.get("effectiveDateTime"), with_time=True),
+    }
+
+
+def condition_row(condition: dict) -> dict:
+    """Condition columns"""
+    return {
+        "id": condition.get("id"),
+        "patient_id": subject_patient_id(condition),
+        "code": (condition.get("code") or {}).get("text"),
+        "onset": iso_date(condition.get("onsetDateTime"), with_time=True),
+        "abatement": iso_date(condition.get("abatementDateTime"), with_time=True),
+    }
+
+
+def patient_to_string(patient: dict) -> str:
+    """Demographic text of a patient, from the patient's JSON"""
+    patient_text_parts = []
+
+    # Basic info
+    if patient.get("gender"):
+        patient_text_parts.append(f"Gender: {patient['gender']}")
+
+    if patient.get("birthDate"):
+        patient_text_parts.append(f"Birth date: {iso_date(patient['birthDate'])}")
+
+    if patient.get("deceasedBoolean") is not None:
+        status = "deceased" if patient["deceasedBoolean"] else "alive"
+        patient_text_parts.append(f"Status: {status}")
+
+    # Name
+    if patient.get("name"):
+        names = []
+        for n in patient["name"]:
+            full_name = (
+                " ".join(n.get("prefix") or [])
+                + " "
+                + " ".join(n.get("given") or [])
+                + " "
+                + (n.get("family") or "")
+            )
+            names.append(full_name.strip())
+        patient_text_parts.append(f"Name(s): {', '.join(names)}")
+
+    # Race and Ethnicity
+    for ext in patient.get("extension") or []:
+        url = (ext.get("url") or "").lower()
+        # Only the first nested extension is read
+        nested = ext.get("extension") or []
+        if "race" in url:
+            text = nested[0].get("valueString") if nested else None
+            if text:
+                patient_text_parts.append(f"Race: {text}")
+        if "ethnicity" in url:
+            text = nested[0].get("valueString") if nested else None
+            if text:
+                patient_text_parts.append(f"Ethnicity: {text}")
+        if "birthsex" in url:
+            patient_text_parts.append(f"Birth sex: {ext.get('valueCode')}")
+        if "birthplace" in url:
+            addr = ext.get("valueAddress") or {}
+            parts = [addr.get("city"), addr.get("state"), addr.get("country")]
+            patient_text_parts.append(f"Birthplace: {', '.join(filter(None, parts))}")
+
+    # Marital status
+    marital_text = (patient.get("maritalStatus") or {}).get("text")
+    if marital_text:
+        patient_text_parts.append(f"Marital status: {marital_text}")
+
+    # Multiple birth
+    if patient.get("multipleBirthBoolean") is not None:
+        patient_text_parts.append(f"Multiple birth: {patient['multipleBirthBoolean']}")
+
+    # Communication / languages
+    languages = [
+        (c.get("language") or {}).get("text")
+        for c in patient.get("communication") or []
+    ]
+    languages = [language for language in languages if language]
+    if languages:
+        patient_text_parts.append(f"Languages: {', '.join(languages)}")
+
+    # Combine all patient information
+    return " | ".join(patient_text_parts) if patient_text_parts else "Unknown patient"
+
+
+def observation_to_string(observation: dict) -> str:
+    """
+    Text of an observation, from the observation's JSON. Symptoms searched
+    for get the same text from embeddings.observation_to_string
+    """
+    obs_text_parts = []
+
+    code_text = (observation.get("code") or {}).get("text")
+    if code_text:
+        obs_text_parts.append(f"Observation: {code_text}")
+
+    # Handle different value types
+    if observation.get("valueQuantity"):
+        value = observation["valueQuantity"].get("value")
+        unit = observation["valueQuantity"].get("unit")
+        if value is not None:
+            value_text = f"Value: {value}"
+            if unit:
+                value_text += f" {unit}"
+            obs_text_parts.append(value_text)
+    elif observation.get("valueString"):
+        obs_text_parts.append(f"Value: {observation['valueString']}")
+    elif observation.get("valueBoolean") is not None:
+        obs_text_parts.append(f"Value: {observation['valueBoolean']}")
+
+    if observation.get("effectiveDateTime"):
+        effective = iso_date(observation["effectiveDateTime"], with_time=True)
+        obs_text_parts.append(f"Date: {effective}")
+
+    # Combine all observation information
+    return " | ".join(obs_text_parts) if obs_text_parts else "Unknown observation"
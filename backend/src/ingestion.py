@@ -0,0 +1,418 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator
+
+from tqdm import tqdm
+
+from .db import Database
+from .embeddings import code_to_string, condition_code_to_string, text_hash
+from .fhir_stream import iter_bundle_rows
+
+# Marks the end of the stream on the queues between stages
+_DONE = None
+
+
+def file_stat(file: str) -> tuple[int, float]:
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime
+
+
+def parse_chunks(
+    file: str, known_hash: str | None = None, chunk_rows: int = 1000
+) -> Iterator[dict]:
+    """
+    Parse a FHIR bundle file into chunks of at most chunk_rows plain row
+    records (see fhir_stream.patient_row etc.), with the text to embed stored
+    under "text". The bundle is read as a stream, one entry at a time, and
+    only one chunk is held at once, so memory doesn't grow with the bundle.
+    Patients come before the observations and conditions referencing them
+    (records listed before their patient are held until it is seen, Synthea
+    bundles list the patient first).
+    Every chunk carries the file's path, size, mtime and content hash, the
+    last one has "final" set. If the file content still matches known_hash it
+    is not parsed, and a single empty chunk marked "unchanged" is yielded.
+    """
+    size, mtime = file_stat(file)
+    content_hash = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            content_hash.update(chunk)
+    content_hash = content_hash.hexdigest()
+
+    def new_chunk() -> dict:
+        return {
+            "path": file,
+            "size": size,
+            "mtime": mtime,
+            "content_hash": content_hash,
+            "unchanged": content_hash == known_hash,
+            "final": False,
+            "patients": [],
+            "observations": [],
+            "conditions": [],
+        }
+
+    chunk = new_chunk()
+    if not chunk["unchanged"]:
+        rows = 0
+        for rtype, row in iter_bundle_rows(file):
+            if rows >= chunk_rows:
+                yield chunk
+                chunk = new_chunk()
+                rows = 0
+
+            if rtype == "Patient":
+                row["text_hash"] = text_hash(row["text"])
+                chunk["patients"].append(row)
+            elif rtype == "Observation":
+                row["text_hash"] = text_hash(row["text"])
+                chunk["observations"].append(row)
+            elif rtype == "Condition":
+                chunk["conditions"].append(row)
+            rows += 1
+
+    chunk["final"] = True
+    yield chunk
+
+
+def chunk_size(chunk: dict) -> int:
+    return len(chunk["patients"]) + len(chunk["observations"]) + len(chunk["conditions"])
+
+
+# Queue the parser processes put their chunks on, set by _init_parser
+_chunk_queue = None
+
+
+def _init_parser(chunk_queue):
+    global _chunk_queue
+    _chunk_queue = chunk_queue
+
+
+def parse_file(file: str, known_hash: str | None = None, chunk_rows: int = 1000):
+    """
+    Parse a file in a parser process, putting its chunks on the chunk queue
+    as they are parsed (see parse_chunks). The queue is bounded, so a parser
+    waits for the embedder instead of running ahead of it. If parsing fails
+    part way, a final chunk carrying the error is sent instead, so the file
+    isn't recorded as ingested.
+    """
+    try:
+        for chunk in parse_chunks(file, known_hash, chunk_rows):
+            _chunk_queue.put(chunk)
+    except Exception as e:
+        _chunk_queue.put(
+            {
+                "path": file,
+                "unchanged": False,
+                "final": True,
+                "error": str(e),
+                "patients": [],
+                "observations": [],
+                "conditions": [],
+            }
+        )
+
+
+def embed_parsed(db: Database, parsed_files: list[dict], batch_size: int) -> int:
+    """
+    Embed the patient, observation and condition texts of several parsed
+    chunks with one batched encode call, storing each vector (a float32
+    array) on its row.
+    Patients and observations whose stored text hash is unchanged keep their
+    current embedding and are skipped, ones whose text another stored row
+    already has reuse that row's embedding. Conditions, only a code, come
+    from the in-memory embedding cache after the first time.
+    Returns: number of texts embedded
+    """
+    rows = []
+    for table in ("patients", "observations"):
+        table_rows = [row for parsed in parsed_files for row in parsed[table]]
+        stored_hashes = db.get_text_hashes(table, [row["id"] for row in table_rows])
+        changed = []
+        for row in table_rows:
+            if stored_hashes.get(row["id"]) == row["text_hash"]:
+                # Upserting a NULL embedding keeps the stored one
+                row["embedding"] = None
+            else:
+                changed.append(row)
+
+        existing = db.get_embeddings_by_text_hash(
+            table, list({row["text_hash"] for row in changed})
+        )
+        for row in changed:
+            if row["text_hash"] in existing:
+                row["embedding"] = existing[row["text_hash"]]
+            else:
+                rows.append(row)
+    rows.extend(
+        row for parsed in parsed_files for row in parsed["conditions"] if row["text"]
+    )
+
+    # Identical texts in this batch are only encoded once. The vectors live on
+    # the rows, so they aren't added to the embedding_cache table
+    embeddings = db.embedding_cache.encode(
+        [row["text"] for row in rows], batch_size, use_store=False
+    )
+    for row, embedding in zip(rows, embeddings):
+        row["embedding"] = embedding
+    return len(rows)
+
+
+def write_chunk(
+    db: Database, chunk: dict, write_batch_size: int, files: dict
+) -> dict | None:
+    """
+    Save one embedded chunk, patients before the observations and conditions
+    that reference them, and commit it. files holds the progress of the files
+    whose final chunk hasn't been written yet, by path. With the final chunk
+    the EMR summaries and clinical embeddings of the file's patients are
+    refreshed, and the file is recorded in the ingestion manifest only if
+    every row saved, so an interrupted or partly failed file is picked up
+    again next run (its rows are upserts, writing them again is harmless).
+    Returns: {"failed_rows", "error", "unchanged"} for the file once its
+    final chunk is handled, otherwise None
+    """
+    progress = files.setdefault(
+        chunk["path"], {"patient_ids": set(), "failed_rows": 0, "error": None}
+    )
+    if chunk.get("error") and not progress["error"]:
+        progress["error"] = chunk["error"]
+
+    try:
+        if not progress["error"] and not chunk["unchanged"]:
+            results = [
+                db.upsert_patients(chunk["patients"], write_batch_size),
+                db.upsert_observations(chunk["observations"], write_batch_size),
+                db.upsert_conditions(chunk["conditions"], write_batch_size),
+            ]
+            progress["failed_rows"] += sum(result.failed_rows for result in results)
+
+            # Cached EMR summaries and clinical embeddings of every patient
+            # touched need to be regenerated once the whole file is in
+            progress["patient_ids"].update(row["id"] for row in chunk["patients"])
+            progress["patient_ids"].update(
+                row["patient_id"]
+                for row in chunk["observations"] + chunk["conditions"]
+                if row["patient_id"]
+            )
+            db.commit_connection()
+
+        if chunk["final"] and not progress["error"]:
+            if progress["patient_ids"]:
+                db.mark_emr_summaries_stale(progress["patient_ids"])
+                db.refresh_clinical_embeddings(progress["patient_ids"])
+            # An unchanged file only has its size/mtime updated
+            if not progress["failed_rows"]:
+                save_manifest_entry(db, chunk)
+            db.commit_connection()
+    except Exception as e:
+        db.rollback_commit()
+        progress["error"] = str(e)
+
+    if not chunk["final"]:
+        return None
+    del files[chunk["path"]]
+    return {
+        "failed_rows": progress["failed_rows"],
+        "error": progress["error"],
+        "unchanged": chunk["unchanged"],
+    }
+
+
+def embed_observation_codes(db: Database, batch_size: int) -> int:
+    """
+    Add the observation codes stored since the last run to the code
+    vocabulary, also backfilling codes ingested before it existed.
+    Returns: number of codes added
+    """
+    codes = db.get_unembedded_observation_codes()
+    for start in range(0, len(codes), batch_size):
+        batch = codes[start : start + batch_size]
+        embeddings = db.embedding_cache.encode(
+            [code_to_string(code) for code in batch], batch_size, use_store=False
+        )
+        db.save_observation_codes(dict(zip(batch, embeddings)))
+    return len(codes)
+
+
+def backfill_clinical_embeddings(db: Database, batch_size: int, write_batch_size: int) -> int:
+    """
+    Embed conditions stored before conditions had embeddings, and compute the
+    clinical embedding of every patient that has none yet, so data ingested
+    before clinical embeddings existed is covered without re-ingesting it.
+    Returns: number of patients whose clinical embedding was computed
+    """
+    patient_ids = set()
+    codes = db.get_unembedded_condition_codes()
+    try:
+        for start in range(0, len(codes), batch_size):
+            batch = codes[start : start + batch_size]
+            embeddings = db.embedding_cache.encode(
+                [condition_code_to_string(code) for code in batch],
+                batch_size,
+                use_store=False,
+            )
+            patient_ids |= db.save_condition_embeddings(dict(zip(batch, embeddings)))
+            db.commit_connection()
+
+        patient_ids.update(db.get_patients_without_clinical_embedding())
+        patient_ids = sorted(patient_ids)
+        for start in range(0, len(patient_ids), write_batch_size):
+            db.refresh_clinical_embeddings(patient_ids[start : start + write_batch_size])
+            db.commit_connection()
+    except Exception:
+        db.rollback_commit()
+        raise
+    return len(patient_ids)
+
+
+def save_manifest_entry(db: Database, parsed: dict):
+    db.save_manifest_entry(
+        parsed["path"], parsed["size"], parsed["mtime"], parsed["content_hash"]
+    )
+
+
+def run_pipeline(
+    db: Database,
+    files: list[str],
+    parser_workers: int,
+    embedding_batch_size: int,
+    write_batch_size: int,
+    chunk_rows: int,
+    queue_rows: int,
+) -> dict:
+    """
+    Ingest files through three stages connected by bounded queues:
+    a pool of parser processes, an embedding thread that batches texts across
+    chunks, and a writer thread that owns the database connection. Files move
+    through the stages in chunks of at most chunk_rows rows, and each queue
+    holds about queue_rows rows, so a full queue blocks the stage feeding it
+    and memory stays bounded whatever the size of the bundles.
+    Files whose size and mtime match the ingestion manifest are skipped
+    without being read, files whose content hash matches are not parsed.
+    New observation codes are added to the code vocabulary at the end, and
+    clinical embeddings missing from earlier ingestions are filled in.
+    Returns: {"successful_files", "skipped_files", "failed_files", "failed_rows",
+    "new_codes", "backfilled_patients"}
+    """
+    manifest = db.get_manifest(files)
+    changed_files = []
+    for file in files:
+        entry = manifest.get(file)
+        if entry is None or (entry[0], entry[1]) != file_stat(file):
+            changed_files.append(file)
+
+    queue_chunks = max(1, queue_rows // chunk_rows)
+    # Filled straight from the parser processes
+    chunk_queue = multiprocessing.Queue(maxsize=queue_chunks)
+    write_queue = queue.Queue(maxsize=queue_chunks)
+
+    stats = {
+        "successful_files": 0,
+        "skipped_files": len(files) - len(changed_files),
+        "failed_files": 0,
+        "failed_rows": 0,
+    }
+    stats_lock = threading.Lock()
+
+    def count(key, amount=1):
+        with stats_lock:
+            stats[key] += amount
+
+    parsed_bar = tqdm(total=len(changed_files), desc="Parsed", unit="file", position=0)
+    embedded_bar = tqdm(desc="Embedded", unit="text", position=1)
+    written_bar = tqdm(desc="Written", unit="row", position=2)
+
+    def embed_stage():
+        pending = []
+        pending_texts = 0
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is not _DONE:
+                pending.append(chunk)
+                pending_texts += chunk_size(chunk)
+
+            # Embed once a full batch of texts is waiting, or the stream ended
+            if pending and (chunk is _DONE or pending_texts >= embedding_batch_size):
+                try:
+                    embedded_bar.update(embed_parsed(db, pending, embedding_batch_size))
+                except Exception as e:
+                    print(f"\nError embedding {len(pending)} chunks: {e}")
+                    for failed in pending:
+                        failed["error"] = str(e)
+                for embedded in pending:
+                    write_queue.put(embedded)
+                pending = []
+                pending_texts = 0
+
+            if chunk is _DONE:
+                write_queue.put(_DONE)
+                return
+
+    def write_stage():
+        files_in_progress = {}
+        while (chunk := write_queue.get()) is not _DONE:
+            result = write_chunk(db, chunk, write_batch_size, files_in_progress)
+            written_bar.update(chunk_size(chunk))
+            if result is None:
+                continue
+            if result["error"]:
+                print(f"\nFailed to save {chunk['path']}: {result['error']}")
+                count("failed_files")
+            else:
+                count("failed_rows", result["failed_rows"])
+                count("skipped_files" if result["unchanged"] else "successful_files")
+
+    pool = ProcessPoolExecutor(
+        max_workers=parser_workers, initializer=_init_parser, initargs=(chunk_queue,)
+    )
+    remaining = iter(changed_files)
+    in_flight = {}
+
+    def submit_next():
+        file = next(remaining, None)
+        if file is not None:
+            known_hash = manifest[file][2] if file in manifest else None
+            in_flight[pool.submit(parse_file, file, known_hash, chunk_rows)] = file
+
+    # One file per parser process, each streams its chunks into the bounded
+    # chunk queue. The parser processes are forked here, before the stage
+    # threads start
+    for _ in range(parser_workers):
+        submit_next()
+
+    embedder = threading.Thread(target=embed_stage, name="embed-stage")
+    writer = threading.Thread(target=write_stage, name="write-stage")
+    embedder.start()
+    writer.start()
+
+    try:
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = in_flight.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    # The parser process died, parse errors arrive as a chunk
+                    print(f"\nFailed to parse {file}: {e}")
+                    count("failed_files")
+                parsed_bar.update(1)
+                submit_next()
+    finally:
+        pool.shutdown(cancel_futures=True)
+        chunk_queue.put(_DONE)
+        embedder.join()
+        writer.join()
+        for bar in (parsed_bar, embedded_bar, written_bar):
+            bar.close()
+
+    stats["new_codes"] = embed_observation_codes(db, embedding_batch_size)
+    stats["backfilled_patients"] = backfill_clinical_embeddings(
+        db, embedding_batch_size, write_batch_size
+    )
+    return stats
@@ -0,0 +1,374 @@
+# Versioned database schema. Each migration runs once, in order, in its own
+# transaction, and is recorded in the schema_version table. Apply them with
+# `python migrate.py`, Database() only checks the recorded version.
+#
+# To change the schema, append a migration with the next version number.
+# Never edit one that has already been released.
+
+import os
+
+import psycopg2
+
+# Serializes concurrent `migrate.py` runs, any constant unique to this app
+MIGRATION_LOCK_ID = 804_217_001
+
+
+def initial_schema(cursor):
+    # Enable pgvector extension
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+
+    # Create patients table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS patients (
+            id VARCHAR PRIMARY KEY,
+            first_name VARCHAR,
+            last_name VARCHAR,
+            gender VARCHAR,
+            birth_date DATE,
+            deceased BOOLEAN,
+            embedding vector(384),  -- 384 dimensions for all-MiniLM-L6-v2
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+    )
+
+    # Create observations table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS observations (
+            id VARCHAR PRIMARY KEY,
+            patient_id VARCHAR,
+            code TEXT,
+            value FLOAT,
+            unit VARCHAR,
+            date TIMESTAMP,
+            embedding vector(384),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients(id)
+        );
+    """
+    )
+
+    # Create conditions table
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conditions (
+            id VARCHAR PRIMARY KEY,
+            patient_id VARCHAR,
+            code TEXT,
+            onset TIMESTAMP,
+            abatement TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients(id)
+        );
+    """
+    )
+
+
+def add_text_hashes(cursor):
+    # Hash of the text each embedding was generated from, so unchanged
+    # records are not re-embedded on the next ingestion
+    cursor.execute("ALTER TABLE patients ADD COLUMN IF NOT EXISTS text_hash VARCHAR;")
+    cursor.execute("ALTER TABLE observations ADD COLUMN IF NOT EXISTS text_hash VARCHAR;")
+    # Rows with the same text share one embedding, found through these
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS patients_text_hash_idx ON patients (text_hash);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS observations_text_hash_idx ON observations (text_hash);"
+    )
+
+
+def create_embedding_cache(cursor):
+    # One vector per distinct query-time text (ingested rows keep theirs on
+    # the row), capped at EMBEDDING_STORE_MAX_ENTRIES newest entries
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            text_hash VARCHAR PRIMARY KEY,
+            embedding vector(384) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS embedding_cache_created_idx ON embedding_cache (created_at);"
+    )
+
+
+def create_ingestion_manifest(cursor):
+    # One row per fully ingested file
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ingestion_manifest (
+            path TEXT PRIMARY KEY,
+            size BIGINT NOT NULL,
+            mtime DOUBLE PRECISION NOT NULL,
+            content_hash VARCHAR NOT NULL,
+            ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+    )
+
+
+def create_emr_summaries(cursor):
+    # Cached GPT summaries of a patient's records
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS emr_summaries (
+            patient_id VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR NOT NULL,
+            summary JSONB NOT NULL,
+            stale BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients(id)
+        );
+    """
+    )
+
+
+# Tables with an embedding column indexed for approximate nearest neighbour search
+VECTOR_INDEXED_TABLES = ("observations", "patients")
+
+# Every approximate nearest neighbour index as (table, column), including the
+# ones later migrations add. All of them are rebuilt by python migrate.py reindex
+VECTOR_INDEXES = (
+    ("observations", "embedding"),
+    ("patients", "embedding"),
+    ("observation_codes", "embedding"),
+    ("patients", "clinical_embedding"),
+)
+
+
+# Indexed expression and operator class for each VECTOR_STORAGE mode, see db.py
+STORAGE_INDEXES = {
+    "full": ("{column}", "vector_cosine_ops"),
+    "halfvec": ("{column}", "halfvec_cosine_ops"),
+    "binary": ("(binary_quantize({column})::bit(384))", "bit_hamming_ops"),
+}
+
+
+def vector_index_name(table: str, column: str = "embedding") -> str:
+    return f"{table}_{column}_idx"
+
+
+def vector_index_sql(table: str, storage: str = "full", column: str = "embedding") -> str:
+    """
+    CREATE INDEX for a table's embedding column (or another vector column),
+    with the build parameters from VECTOR_INDEX_TYPE (hnsw or ivfflat),
+    HNSW_M, HNSW_EF_CONSTRUCTION and IVFFLAT_LISTS
+    """
+    index_type = os.environ.get("VECTOR_INDEX_TYPE", "hnsw")
+    if index_type == "hnsw":
+        options = (
+            f"m = {int(os.environ.get('HNSW_M', 16))}, "
+            f"ef_construction = {int(os.environ.get('HNSW_EF_CONSTRUCTION', 64))}"
+        )
+    elif index_type == "ivfflat":
+        # Lists are fixed at build time, roughly rows / 1000 works well, so
+        # build it after ingestion (python migrate.py reindex)
+        options = f"lists = {int(os.environ.get('IVFFLAT_LISTS', 100))}"
+    else:
+        raise ValueError(f"Unknown vector index type {index_type}, expected hnsw or ivfflat")
+
+    expression, opclass = STORAGE_INDEXES[storage]
+    expression = expression.format(column=column)
+    return (
+        f"CREATE INDEX IF NOT EXISTS {vector_index_name(table, column)} ON {table} "
+        f"USING {index_type} ({expression} {opclass}) WITH ({options});"
+    )
+
+
+def create_vector_indexes(cursor):
+    for table in VECTOR_INDEXED_TABLES:
+        cursor.execute(vector_index_sql(table))
+
+
+def rebuild_vector_indexes(db):
+    """Drop and build the embedding indexes again, e.g. with new build parameters"""
+    for table, column in VECTOR_INDEXES:
+        # Only observation embeddings support compact storage
+        storage = "full"
+        if (table, column) == ("observations", "embedding"):
+            storage = os.environ.get("VECTOR_STORAGE", "full")
+        index_name = vector_index_name(table, column)
+        with db.transaction() as cursor:
+            print(f"Rebuilding {index_name}")
+            cursor.execute(f"DROP INDEX IF EXISTS {index_name};")
+            cursor.execute(vector_index_sql(table, storage, column))
+
+
+def convert_observation_storage(db, storage: str):
+    """
+    Switch observations.embedding to another VECTOR_STORAGE mode, converting
+    the stored rows and rebuilding the index. Opt-in, so it is a command
+    (python migrate.py compact <mode>) rather than a numbered migration. Going
+    back from halfvec to full keeps the half precision values.
+    """
+    if storage not in STORAGE_INDEXES:
+        raise ValueError(
+            f"Unknown vector storage {storage}, expected one of {', '.join(STORAGE_INDEXES)}"
+        )
+    column_type = "halfvec(384)" if storage == "halfvec" else "vector(384)"
+
+    with db.transaction() as cursor:
+        print(f"Converting observation embeddings to {storage} storage")
+        cursor.execute("DROP INDEX IF EXISTS observations_embedding_idx;")
+        # A no-op when the column already has this type, otherwise a table rewrite
+        cursor.execute(
+            f"""
+            ALTER TABLE observations ALTER COLUMN embedding TYPE {column_type}
+            USING embedding::{column_type};
+        """
+        )
+        cursor.execute(vector_index_sql("observations", storage))
+    print(f"Done, run the app and ingestion with VECTOR_STORAGE={storage}")
+
+
+def create_observation_codes(cursor):
+    # One embedding per distinct observation code, the vocabulary symptom
+    # search runs nearest neighbour over before joining back to observations
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS observation_codes (
+            code TEXT PRIMARY KEY,
+            embedding vector(384) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+    )
+    cursor.execute(vector_index_sql("observation_codes"))
+    # Same order as the code lookup's ORDER BY date DESC NULLS LAST, which
+    # plain DESC (nulls first) doesn't serve
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS observations_code_idx
+        ON observations (code, date DESC NULLS LAST);
+    """
+    )
+
+
+def create_patient_record_indexes(cursor):
+    # A patient's most recent observations are read straight off this index,
+    # newest first, without visiting the table
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS observations_patient_date_idx
+        ON observations (patient_id, date DESC NULLS LAST)
+        INCLUDE (id, code, value, unit);
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS conditions_patient_idx ON conditions (patient_id);"
+    )
+
+
+def add_clinical_embeddings(cursor):
+    # Conditions are embedded from their code, and each patient gets a second
+    # embedding aggregated from their condition and observation embeddings
+    cursor.execute("ALTER TABLE conditions ADD COLUMN IF NOT EXISTS embedding vector(384);")
+    cursor.execute(
+        "ALTER TABLE patients ADD COLUMN IF NOT EXISTS clinical_embedding vector(384);"
+    )
+    cursor.execute(vector_index_sql("patients", column="clinical_embedding"))
+
+
+# (version, description, function applying it to a cursor). The first ones use
+# IF NOT EXISTS so databases created before versioning are adopted as they are
+MIGRATIONS = [
+    (1, "create patients, observations and conditions", initial_schema),
+    (2, "add text hashes of embedded texts", add_text_hashes),
+    (3, "create embedding cache", create_embedding_cache),
+    (4, "create ingestion manifest", create_ingestion_manifest),
+    (5, "create EMR summary cache", create_emr_summaries),
+    (6, "index embeddings for approximate nearest neighbour search", create_vector_indexes),
+    (7, "create observation code vocabulary", create_observation_codes),
+    (8, "index conditions and observations by patient", create_patient_record_indexes),
+    (9, "add condition and clinical patient embeddings", add_clinical_embeddings),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def current_version(cursor) -> int:
+    """Highest applied migration, 0 for a database that was never migrated"""
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    return cursor.fetchone()[0]
+
+
+def check_schema(db):
+    """
+    Cheap startup check, one catalog lookup and one indexed read.
+    Raises SchemaVersionError if migrations are pending.
+    """
+    with db.transaction() as cursor:
+        version = current_version(cursor)
+
+    if version < LATEST_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {version}, this code needs {LATEST_VERSION}. "
+            "Run `python migrate.py` first"
+        )
+    if version > LATEST_VERSION:
+        print(
+            f"Database schema is at version {version}, newer than this code "
+            f"({LATEST_VERSION})"
+        )
+
+
+def migrate(db, target: int | None = None) -> list[int]:
+    """
+    Apply the pending migrations up to target (default: all of them).
+    Returns: versions applied
+    """
+    target = LATEST_VERSION if target is None else target
+    applied = []
+
+    # Pooled connections register the vector type on checkout, which fails
+    # until the extension exists, so it is created on a separate connection
+    connection = psycopg2.connect(
+        dbname=db.dbname, user=db.user, password=db.password, host=db.host, port=db.port
+    )
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    finally:
+        connection.close()
+
+    with db.transaction() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """
+        )
+
+    for version, description, apply in MIGRATIONS:
+        if version > target:
+            break
+        with db.transaction() as cursor:
+            # Held until commit, a second migrate.py waits here and then skips
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            if current_version(cursor) >= version:
+                continue
+
+            print(f"Applying migration {version}: {description}")
+            apply(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                (version, description),
+            )
+            applied.append(version)
+
+    return applied
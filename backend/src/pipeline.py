@@ -0,0 +1,56 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+
+class Stage:
+    """A unit of work in a pipeline, run once all of its dependencies are done"""
+
+    def __init__(self, func: Callable[..., Any], *deps: str):
+        self.func = func
+        self.deps = deps
+
+
+def run_stages(stages: dict[str, Stage], max_workers: int | None = None) -> dict:
+    """
+    Run a dependency graph of stages on a thread pool.
+
+    Each stage starts as soon as every stage it depends on has finished, and is
+    called with the results of those dependencies as positional arguments (in
+    the order they were declared). Independent stages run at the same time, so
+    total latency is bounded by the slowest dependency chain.
+    Returns: {stage_name: result}. The first stage to fail re-raises its error.
+    """
+    for name, stage in stages.items():
+        for dep in stage.deps:
+            if dep not in stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1)
+    try:
+        while pending or running:
+            # Submit every stage whose dependencies have all finished
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    args = [results[dep] for dep in stage.deps]
+                    running[pool.submit(stage.func, *args)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Dependency cycle between stages: {list(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+    except BaseException:
+        # Fail fast: stages already running can't be stopped, but the error
+        # is raised without waiting for them to finish
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    pool.shutdown()
+    return results
@@ -2,7 +2,6 @@ import os, json, uuid
 from openai import OpenAI
 from fhir.resources.observation import Observation
 
-from datetime import date
 
 from .embeddings import (
     observation_to_string,
@@ -12,19 +11,22 @@ from .db import (
     Database
 )
 
-from .summarizer import (
-    summarize_patient_info
+from .emr import (
+    get_patient_records,
+    get_patient_records_many
 )
 
-#CHECK
-db = Database()
-connection = db.get_connection()
-
+from .summarizer import (
+    cached_patient_summary
+)
 
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 max_per_symptom = 5
 max_patients_returned = 2
 
+# "codes" searches the observation code vocabulary, "observations" every stored observation
+symptom_search_mode = os.environ.get("SYMPTOM_SEARCH_MODE", "codes")
+
 
 def split_symptoms(input:str) -> list[str]:
     prompt = f"""
@@ -101,15 +103,81 @@ def text_to_observation(text: str) -> Observation:
     raw = resp.choices[0].message.content.strip()
 
     # Robust JSON extraction (handles stray prose/backticks)
+    data = extract_json(raw, "{", "}")
+
+    # Return a typed FHIR Observation (raises if invalid)
+    return coerce_observation(data)
+
+
+def text_to_observations(text: str) -> list[Observation]:
+    """
+    Split clinical free text into symptoms and convert all of them into FHIR R4
+    Observations with a single LLM call. Falls back to split_symptoms plus one
+    text_to_observation call per symptom if the batched response is unusable.
+    """
+    prompt = f"""
+    You are a clinical text segmenter and FHIR converter.
+
+    TASK:
+    Split the INPUT into individual symptom phrases, then convert each phrase into a minimal FHIR R4 Observation.
+
+    SEGMENTING RULES:
+    - Preserve the original wording of each phrase; do NOT correct typos or rephrase.
+    - Do NOT add symptoms not present. Include both symptom complaints and disease/diagnosis terms.
+    - Keep negations with the phrase (e.g., "no fever").
+    - Ignore non-clinical content (greetings, names, roles, pets, places, chit-chat).
+
+    OBSERVATION FORMAT (one per phrase, in input order):
+    {{
+    "resourceType": "Observation",
+    "status": "final",
+    "code": {{ "text": "<short description>" }},
+    "effectiveDateTime": "<ISO-8601>",               // optional
+    "valueQuantity": {{ "value": <number>, "unit": "<UCUM>" }}  // prefer when numeric present
+    OR
+    "valueString": "<string>"
+    OR
+    "valueBoolean": true/false
+    }}
+    - Prefer valueQuantity when a number+unit is present; else valueString; else valueBoolean.
+    - No extra fields.
+
+    Output MUST be ONLY a valid JSON array of Observation objects (no prose, no markdown).
+    If there are no valid symptom/diagnosis phrases, return [].
+
+    INPUT:
+    \"\"\"{text}\"\"\"
+    """
+
+    resp = client.chat.completions.create(
+        model="gpt-5-mini",
+        messages=[{"role": "user", "content": prompt}],
+    )
+    raw = resp.choices[0].message.content.strip()
+
     try:
-        data = json.loads(raw)
+        data = extract_json(raw, "[", "]")
+        if not isinstance(data, list) or not all(isinstance(d, dict) for d in data):
+            raise ValueError(f"LLM did not return a JSON array of objects:\n{raw}")
+        return [coerce_observation(d) for d in data]
+    except Exception as e:
+        print(f"Batched observation extraction failed, falling back: {e}", flush=True)
+        return [text_to_observation(symptom) for symptom in split_symptoms(text)]
+
+
+def extract_json(raw: str, open_char: str, close_char: str):
+    """Parse JSON from an LLM response, ignoring any prose or backticks around it"""
+    try:
+        return json.loads(raw)
     except Exception:
-        i, j = raw.find("{"), raw.rfind("}")
+        i, j = raw.find(open_char), raw.rfind(close_char)
         if i != -1 and j != -1 and j > i:
-            data = json.loads(raw[i:j+1])
-        else:
-            raise ValueError(f"LLM did not return valid JSON:\n{raw}")
+            return json.loads(raw[i:j+1])
+        raise ValueError(f"LLM did not return valid JSON:\n{raw}")
+
 
+def coerce_observation(data: dict) -> Observation:
+    """Fill in minimal defaults and validate into a typed FHIR Observation"""
     # Harden minimal fields & defaults
     data.setdefault("resourceType", "Observation")
     data.setdefault("status", "final")
@@ -122,86 +190,12 @@ def text_to_observation(text: str) -> Observation:
     # Return a typed FHIR Observation (raises if invalid)
     return Observation(**data)
 
-def get_patient_records(patient_id, first_name=None, last_name=None):
-    cursor = connection.cursor()
-
-    # Base query (patient_id required)
-    query = "SELECT id, first_name, last_name, gender, birth_date, deceased FROM patients WHERE id = %s"
-    params = [patient_id]
-
-    if first_name:
-        query += " AND first_name = %s"
-        params.append(first_name)
-    if last_name:
-        query += " AND last_name = %s"
-        params.append(last_name)
-
-    cursor.execute(query, tuple(params))
-    patient = cursor.fetchone()
-    if not patient:
-        return None
-
-    # Calculate age
-    birth_date = patient[4]
-    age = None
-    if birth_date:
-        today = date.today()
-        age = (
-            today.year
-            - birth_date.year
-            - ((today.month, today.day) < (birth_date.month, birth_date.day))
-        )
-
-    # Fetch conditions
-    cursor.execute(
-        "SELECT id, code, onset, abatement FROM conditions WHERE patient_id = %s",
-        (patient_id,),
-    )
-    conditions = cursor.fetchall()
-    conditions_list = [
-        {
-            "id": str(c[0]),
-            "code": str(c[1]),
-            "onset": str(c[2]) if c[2] else None,
-            "abatement": str(c[3]) if c[3] else None,
-        }
-        for c in conditions
-    ]
-
-    # Fetch observations
-    cursor.execute(
-        "SELECT id, code, value, unit, date FROM observations WHERE patient_id = %s",
-        (patient_id,),
-    )
-    observations = cursor.fetchall()
-    observations_list = [
-        {
-            "id": str(o[0]),
-            "code": str(o[1]),
-            "value": str(o[2]) if o[2] is not None else None,
-            "unit": str(o[3]) if o[3] is not None else None,
-            "date": str(o[4]) if o[4] else None,
-        }
-        for o in observations
-    ]
-
-    return {
-        "id": str(patient[0]),
-        "first_name": str(patient[1]),
-        "last_name": str(patient[2]),
-        "gender": str(patient[3]) if patient[3] else "unknown",
-        "age": age,
-        "deceased": patient[5],
-        "conditions": conditions_list,
-        "observations": observations_list,
-    }
-
-def patient_summary(patient_id, first_name = None, last_name = None) -> dict:
-    records = get_patient_records(patient_id, first_name, last_name)
+def patient_summary(db: Database, patient_id, first_name = None, last_name = None) -> dict:
+    records = get_patient_records(db, patient_id, first_name, last_name)
     if not records:
         return {}
 
-    summary = summarize_patient_info(records)
+    summary = cached_patient_summary(db, records)
 
     return summary
 
@@ -210,8 +204,8 @@ def patient_summary(patient_id, first_name = None, last_name = None) -> dict:
 def find_similar_emr(patient_id: str, obs_input: str, db: Database) -> list[tuple[str, str, float]]:
     summaries = {}
 
-    #creates string list of each symptom described
-    symptoms = split_symptoms(obs_input)
+    #converts each symptom described into an Observation in one LLM call
+    observations = text_to_observations(obs_input)
 
     #stores list of 3 element tuples [patient_id, code, similarity]
     results = []
@@ -219,21 +213,29 @@ def find_similar_emr(patient_id: str, obs_input: str, db: Database) -> list[tupl
     #store top patients
     final_results = []
 
-    #for each symptom we add most similar patients to results
-    for symptom in symptoms:
-        obs = text_to_observation(symptom)
-        obs_text = observation_to_string(obs)
-
-        #Adds max_per_symptom more patients
-        results = results + db.find_similar_observations(obs_text, max_per_symptom)
+    #for each symptom we add the max_per_symptom most similar patients to results
+    obs_texts = [observation_to_string(obs) for obs in observations]
+    # Each symptom contributes max_per_symptom distinct patients
+    if symptom_search_mode == "codes":
+        symptom_matches = db.find_similar_observations_by_code(
+            obs_texts, max_per_symptom, distinct_patients=True
+        )
+    else:
+        symptom_matches = db.find_similar_patients_by_observation(obs_texts, max_per_symptom)
+    for symptom_results in symptom_matches:
+        results = results + symptom_results
 
 
-    patient_ids = [pid for (pid, _code, _sim) in results]
+    patient_ids = list(dict.fromkeys(pid for (pid, _code, _sim) in results))
 
     final_results = db.find_similar_patients_from_list(patient_id, patient_ids, max_patients_returned)
 
+    # Records of every similar patient in one round trip
+    records = get_patient_records_many(db, [patient[0] for patient in final_results])
     for patient in final_results:
-        summaries[patient[0]] = patient_summary(patient[0])
+        summaries[patient[0]] = (
+            cached_patient_summary(db, records[patient[0]]) if patient[0] in records else {}
+        )
 
     return summaries
 
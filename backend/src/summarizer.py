@@ -1,43 +1,222 @@
+import hashlib
 import json
 import os
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from Bio import Entrez
 from openai import OpenAI
 
+from .cache import DiskCache
+
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+SUMMARY_MODEL = "gpt-5-mini"
+
+# Max number of article summaries requested from OpenAI at the same time
+summary_workers = int(os.environ.get("SUMMARY_WORKERS", 4))
+
+NO_ABSTRACT = "No abstract available."
+
+# Persistent cache for NCBI responses and article summaries. Abstracts and
+# summaries never change so they have no expiry, esearch results are refreshed
+# after ESEARCH_CACHE_TTL seconds
+pubmed_cache = DiskCache()
+esearch_cache_ttl = float(os.environ.get("ESEARCH_CACHE_TTL", 24 * 60 * 60))
+
+
+# NCBI allows 3 requests per second per client, 10 with an API key. Every
+# E-utilities call in this process shares one limiter, so concurrent tier
+# probes and the efetch after them stay under it
+ncbi_api_key = os.environ.get("NCBI_API_KEY")
+ncbi_rate_limit = float(os.environ.get("NCBI_RATE_LIMIT", 10 if ncbi_api_key else 3))
+ncbi_retries = int(os.environ.get("NCBI_RETRIES", 3))
+
+_ncbi_lock = threading.Lock()
+_ncbi_next_slot = 0.0
+
+
+class NcbiError(RuntimeError):
+    """An E-utilities request failed, as opposed to returning no results"""
+
 
+class NcbiRequestCancelled(NcbiError):
+    """The request was no longer needed and was never sent"""
+
+
+def _wait_for_ncbi_slot(stop: threading.Event | None = None):
+    """
+    Block until this request may be sent, spacing requests 1 / ncbi_rate_limit
+    apart. A slot is only taken when the request is sent, so a request
+    cancelled through stop while waiting doesn't use one up.
+    """
+    global _ncbi_next_slot
+    while True:
+        with _ncbi_lock:
+            now = time.monotonic()
+            if stop is not None and stop.is_set():
+                raise NcbiRequestCancelled("NCBI request cancelled")
+            if now >= _ncbi_next_slot:
+                _ncbi_next_slot = now + 1 / ncbi_rate_limit
+                return
+            delay = _ncbi_next_slot - now
+        if stop is not None:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+
+
+def ncbi_request(method, url, params, stop: threading.Event | None = None, **kwargs):
+    """
+    Send an E-utilities request through the shared rate limiter, retrying
+    rate limited (429) and server errors with backoff. Setting stop gives up
+    before the next attempt is sent.
+    Returns: the response. Raises NcbiError if it still fails.
+    """
+    params = dict(params)
+    if ncbi_api_key:
+        params["api_key"] = ncbi_api_key
+
+    for attempt in range(ncbi_retries + 1):
+        _wait_for_ncbi_slot(stop)
+        try:
+            if method == "POST":
+                resp = requests.post(url, data=params, **kwargs)
+            else:
+                resp = requests.get(url, params=params, **kwargs)
+        except requests.RequestException as e:
+            error = str(e)
+        else:
+            if resp.status_code == 200:
+                return resp
+            error = f"HTTP {resp.status_code}"
+            if resp.status_code != 429 and resp.status_code < 500:
+                break
+
+        if attempt < ncbi_retries:
+            if stop is not None:
+                stop.wait(0.5 * 2**attempt)
+            else:
+                time.sleep(0.5 * 2**attempt)
+
+    raise NcbiError(f"NCBI request to {url} failed: {error}")
+
+
+def search_pubmed(query, max_results=3, stop: threading.Event | None = None):
+    """
+    PubMed ids matching the query, [] if there are none.
+    Raises NcbiError when NCBI fails, so a failed search is never mistaken
+    for one without hits. Setting stop cancels the search if it wasn't sent yet.
+    """
+    cache_key = f"{max_results}:{' '.join(query.split())}"
+    cached = pubmed_cache.get("esearch", cache_key, ttl=esearch_cache_ttl)
+    if cached is not None:
+        return json.loads(cached)
 
-def search_pubmed(query, max_results=3):
     search_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     params = {"db": "pubmed", "term": query, "retmax": max_results, "retmode": "json"}
-    search_resp = requests.get(search_url, params=params).json()
+    search_resp = ncbi_request("GET", search_url, params, stop=stop).json()
 
-    if "esearchresult" not in search_resp:
-        # No studies found
-        return []
+    # A search without hits still has an esearchresult, with an empty idlist
+    result = search_resp.get("esearchresult")
+    if "error" in search_resp or result is None or "ERROR" in result:
+        error = search_resp.get("error") or (result or {}).get("ERROR")
+        raise NcbiError(f"PubMed search failed: {error or search_resp}")
 
-    return search_resp["esearchresult"].get("idlist", [])
+    ids = result.get("idlist", [])
+    pubmed_cache.set("esearch", cache_key, json.dumps(ids))
+    return ids
 
 
-def fetch_abstract(pubmed_id):
+def probe_tiers(queries, max_results=3):
+    """
+    Run the esearch for every tier query at once and return the first tier
+    (in priority order) that has results, without waiting on lower tiers.
+    The requests themselves are paced by the shared NCBI rate limiter, and
+    lower tiers that haven't been sent once a tier wins are cancelled so
+    they don't take rate limit slots from the efetch that follows.
+    Returns: (tier_num, query, ids), or (None, None, []) if no tier has results.
+    Raises NcbiError if a tier that would decide the result failed.
+    """
+    if not queries:
+        return None, None, []
+
+    # No more requests in flight than NCBI accepts per second
+    pool = ThreadPoolExecutor(max_workers=min(len(queries), max(1, int(ncbi_rate_limit))))
+    stop = threading.Event()
+    try:
+        futures = [
+            pool.submit(search_pubmed, query, max_results, stop) for query in queries
+        ]
+
+        # A tier only wins once every higher priority tier has come back empty
+        for tier_num, (query, future) in enumerate(zip(queries, futures), start=1):
+            ids = future.result()
+            if ids:
+                return tier_num, query, ids
+        return None, None, []
+    finally:
+        # Lower tiers still queued or waiting on the rate limiter are dropped,
+        # ones already sent are ignored
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _article_text(article, tag):
+    return " ".join("".join(elem.itertext()) for elem in article.iter(tag)).strip()
+
+
+def fetch_abstracts(pubmed_ids):
+    """
+    Fetch titles and abstracts for many PubMed articles with one efetch call.
+    The response is parsed as it streams in, one article at a time.
+    Returns: {pubmed_id: (name, abstract)}
+    """
+    if not pubmed_ids:
+        return {}
+
+    articles = {}
+    missing_ids = []
+    for pubmed_id in pubmed_ids:
+        cached = pubmed_cache.get("abstract", pubmed_id)
+        if cached is not None:
+            articles[pubmed_id] = tuple(json.loads(cached))
+        else:
+            missing_ids.append(pubmed_id)
+
+    if not missing_ids:
+        return articles
+
     efetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-    params = {"db": "pubmed", "id": pubmed_id, "retmode": "xml"}
-    resp = requests.get(efetch_url, params=params)
-    resp.encoding = "utf-8"
-    root = ET.fromstring(resp.text)
-    name = " ".join("".join(elem.itertext()) for elem in root.iter("ArticleTitle"))
-    abstract = " ".join("".join(elem.itertext()) for elem in root.iter("AbstractText"))
+    params = {"db": "pubmed", "id": ",".join(missing_ids), "retmode": "xml"}
+    # POST so long id lists don't hit URL length limits
+    resp = ncbi_request("POST", efetch_url, params, stream=True)
+    resp.raw.decode_content = True
 
-    if not abstract.strip():
-        abstract = "No abstract available."
+    for _event, elem in ET.iterparse(resp.raw, events=("end",)):
+        if elem.tag not in ("PubmedArticle", "PubmedBookArticle"):
+            continue
 
-    return name.strip(), abstract.strip()
+        pubmed_id = elem.findtext(".//PMID")
+        name = _article_text(elem, "ArticleTitle") or _article_text(elem, "BookTitle")
+        abstract = _article_text(elem, "AbstractText") or NO_ABSTRACT
+        if pubmed_id:
+            articles[pubmed_id.strip()] = (name, abstract)
+            pubmed_cache.set("abstract", pubmed_id.strip(), json.dumps([name, abstract]))
 
+        # Drop the parsed article so memory stays flat for large batches
+        elem.clear()
 
-def summarize_structured(abstract):
-    prompt = f"""
+    return articles
+
+
+def fetch_abstract(pubmed_id):
+    return fetch_abstracts([pubmed_id]).get(pubmed_id, ("", NO_ABSTRACT))
+
+
+STRUCTURED_SUMMARY_PROMPT = """
 You are a medical data extractor.
 Extract patient info, conditions, symptoms, treatments, results, and diagnosis from the following abstract.
 For each field, you must always provide the **most specific information available in the text**, even if approximate or implied. 
@@ -63,11 +242,70 @@ Return the result as valid JSON in the following format where all variables retu
 Abstract:
 \"\"\"{abstract}\"\"\"
 """
+
+# Cached summaries are keyed on the template text, so editing the prompt above
+# invalidates every summary produced by the old one
+STRUCTURED_SUMMARY_PROMPT_VERSION = hashlib.sha256(
+    STRUCTURED_SUMMARY_PROMPT.encode("utf-8")
+).hexdigest()[:16]
+
+
+def summarize_structured(abstract):
+    cache_key = hashlib.sha256(
+        "\0".join([SUMMARY_MODEL, STRUCTURED_SUMMARY_PROMPT_VERSION, abstract]).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+    cached = pubmed_cache.get("summary", cache_key)
+    if cached is not None:
+        return cached
+
+    prompt = STRUCTURED_SUMMARY_PROMPT.format(abstract=abstract)
     response = client.chat.completions.create(
-        model="gpt-5-mini",
+        model=SUMMARY_MODEL,
         messages=[{"role": "user", "content": prompt}],
     )
-    return response.choices[0].message.content
+    structured_summary = response.choices[0].message.content
+    # A reply that isn't JSON is retried next time instead of served forever
+    try:
+        json.loads(structured_summary)
+    except Exception:
+        return structured_summary
+    pubmed_cache.set("summary", cache_key, structured_summary)
+    return structured_summary
+
+
+def parse_structured_summary(structured_summary):
+    try:
+        return json.loads(structured_summary)
+    except Exception:
+        return {"raw_summary": structured_summary}
+
+
+def summarize_articles(pubmed_ids):
+    """
+    Fetch all abstracts in one batch, then summarize them concurrently.
+    Returns: [{"name", "pubmed_id", "summary"}, ...] in the order of pubmed_ids
+    """
+    if not pubmed_ids:
+        return []
+
+    articles = fetch_abstracts(pubmed_ids)
+    print("Got abstracts", flush=True)
+
+    abstracts = [articles.get(pid, ("", NO_ABSTRACT))[1] for pid in pubmed_ids]
+    with ThreadPoolExecutor(max_workers=min(summary_workers, len(abstracts))) as pool:
+        structured_summaries = list(pool.map(summarize_structured, abstracts))
+    print("Got summaries", flush=True)
+
+    return [
+        {
+            "name": articles.get(pid, ("", NO_ABSTRACT))[0],
+            "pubmed_id": pid,
+            "summary": parse_structured_summary(structured_summary),
+        }
+        for pid, structured_summary in zip(pubmed_ids, structured_summaries)
+    ]
 
 
 # generates summaries based on pub med articles found from queries
@@ -78,21 +316,7 @@ def get_structured_summaries(query, max_results=3):
 
     print("Got ids", ids, flush=True)
 
-    print("Got ids", ids, flush=True)
-
-    results = []
-    for pid in ids:
-        abstract = fetch_abstract(pid)
-        print("Got abstract", flush=True)
-        structured_summary = summarize_structured(abstract)
-        print("Got summary", flush=True)
-        try:
-            structured_json = json.loads(structured_summary)
-        except:
-            structured_json = {"raw_summary": structured_summary}
-
-        results.append({"pubmed_id": pid, "summary": structured_json})
-    return results
+    return summarize_articles(ids)
 
 
 def conditions_to_string(conditions):
@@ -128,13 +352,50 @@ def observations_to_string(observations):
     return "; ".join(parts)
 
 
+def emr_fingerprint(patient_records):
+    """
+    Hash of everything in a patient's records that feeds their EMR summary,
+    the conditions and the window of recent observations
+    """
+    content = json.dumps(
+        {
+            "gender": patient_records.get("gender"),
+            "age": patient_records.get("age"),
+            "conditions": sorted(
+                patient_records["conditions"], key=lambda c: c.get("id") or ""
+            ),
+            "observations": sorted(
+                patient_records["observations"], key=lambda o: o.get("id") or ""
+            ),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def cached_patient_summary(db, patient_records):
+    """
+    Summarize a patient's EMR, reusing the stored summary unless their
+    conditions or observations changed or ingestion marked it stale.
+    """
+    fingerprint = emr_fingerprint(patient_records)
+    summary = db.get_emr_summary(patient_records["id"], fingerprint)
+    if summary is not None:
+        return summary
+
+    summary = summarize_patient_info(patient_records)
+    # Only keep summaries that parsed, a raw_summary fallback is retried next time
+    if "raw_summary" not in summary:
+        db.save_emr_summary(patient_records["id"], fingerprint, summary)
+    return summary
+
+
 def summarize_patient_info(patient_records):
     conditions_text = conditions_to_string(patient_records["conditions"])
 
-    # Take the 10 most recent observations
-    recent_obs = sorted(
-        patient_records["observations"], key=lambda x: x.get("date") or "", reverse=True
-    )[:10]
+    # Records only carry the most recent observations, newest first
+    # (see emr.recent_observations), already sorted and limited in SQL
+    recent_obs = patient_records["observations"]
 
     # Collapse observations into a concise string
     obs_summary_list = []
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Tests import the backend modules the way the scripts do (from src...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Never touch the on-disk cache from tests
+os.environ.setdefault("CACHE_PATH", ":memory:")
+
+# The OpenAI client refuses to be built without a key, tests never call it
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,73 @@
+import pytest
+
+from src import cache as cache_module
+from src.cache import DiskCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls the time the cache sees, so entries can be aged without sleeping"""
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    return now
+
+
+def test_entries_older_than_ttl_expire(clock):
+    cache = DiskCache(":memory:")
+    cache.set("esearch", "3:fever", '["1"]')
+
+    clock[0] += 59
+    assert cache.get("esearch", "3:fever", ttl=60) == '["1"]'
+
+    clock[0] += 2
+    assert cache.get("esearch", "3:fever", ttl=60) is None
+
+
+def test_entries_without_ttl_never_expire(clock):
+    cache = DiskCache(":memory:")
+    cache.set("abstract", "123", '["Title", "Abstract"]')
+
+    clock[0] += 10 * 365 * 24 * 60 * 60
+    assert cache.get("abstract", "123") == '["Title", "Abstract"]'
+
+
+def test_evicts_least_recently_used_first(clock):
+    cache = DiskCache(":memory:", max_entries=2)
+    cache.set("abstract", "a", "A")
+    clock[0] += 1
+    cache.set("abstract", "b", "B")
+    clock[0] += 1
+
+    # Reading a makes b the least recently used entry
+    assert cache.get("abstract", "a") == "A"
+    clock[0] += 1
+    cache.set("abstract", "c", "C")
+
+    assert cache.get("abstract", "b") is None
+    assert cache.get("abstract", "a") == "A"
+    assert cache.get("abstract", "c") == "C"
+    assert cache.stats()["abstract"]["evictions"] == 1
+
+
+def test_namespaces_are_capped_separately(clock):
+    cache = DiskCache(":memory:", max_entries=1)
+    cache.set("abstract", "a", "A")
+    cache.set("summary", "a", "S")
+
+    assert cache.get("abstract", "a") == "A"
+    assert cache.get("summary", "a") == "S"
+
+
+def test_counts_hits_and_misses_per_namespace(clock):
+    cache = DiskCache(":memory:")
+    cache.set("esearch", "q", "[]")
+
+    cache.get("esearch", "q")
+    cache.get("esearch", "q")
+    cache.get("esearch", "other")
+    cache.get("abstract", "1")
+
+    assert cache.stats() == {
+        "abstract": {"entries": 0, "hits": 0, "misses": 1, "evictions": 0},
+        "esearch": {"entries": 1, "hits": 2, "misses": 1, "evictions": 0},
+    }
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("pgvector")
+pytest.importorskip("tqdm")
+pytest.importorskip("fhir.resources")
+
+from src.ingestion import chunk_size, parse_chunks  # noqa: E402
+
+
+def write_bundle(tmp_path, observations: int):
+    entries = [
+        {
+            "resource": {
+                "resourceType": "Observation",
+                "id": f"o{i}",
+                "subject": {"reference": "urn:uuid:p1"},
+                "code": {"text": "Heart rate"},
+                "valueQuantity": {"value": 60 + i, "unit": "/min"},
+                "effectiveDateTime": "2020-01-01T00:00:00+00:00",
+            }
+        }
+        for i in range(observations)
+    ]
+    # The patient after its observations, they are held back until it is seen
+    entries.append(
+        {"resource": {"resourceType": "Patient", "id": "p1", "gender": "female"}}
+    )
+    path = tmp_path / "bundle.json"
+    path.write_text(json.dumps({"resourceType": "Bundle", "entry": entries}))
+    return str(path)
+
+
+def test_bundle_is_streamed_in_bounded_chunks(tmp_path):
+    path = write_bundle(tmp_path, observations=25)
+
+    chunks = list(parse_chunks(path, chunk_rows=10))
+
+    assert [chunk_size(chunk) for chunk in chunks] == [10, 10, 6]
+    assert [chunk["final"] for chunk in chunks] == [False, False, True]
+    assert [row["id"] for row in chunks[0]["patients"]] == ["p1"]
+    assert sum(len(chunk["observations"]) for chunk in chunks) == 25
+    assert all(row["text_hash"] for chunk in chunks for row in chunk["observations"])
+
+
+def test_unchanged_file_is_one_empty_final_chunk(tmp_path):
+    path = write_bundle(tmp_path, observations=3)
+    (first,) = [chunk for chunk in parse_chunks(path) if chunk["final"]]
+
+    (chunk,) = list(parse_chunks(path, known_hash=first["content_hash"]))
+
+    assert chunk["unchanged"] and chunk["final"]
+    assert chunk_size(chunk) == 0
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from src.pipeline import Stage, run_stages
+
+
+def test_dependencies_receive_results_in_declared_order():
+    results = run_stages(
+        {
+            "a": Stage(lambda: 1),
+            "b": Stage(lambda: 2),
+            "c": Stage(lambda a, b: (a, b), "a", "b"),
+            "d": Stage(lambda c, a: c + (a,), "c", "a"),
+        }
+    )
+    assert results == {"a": 1, "b": 2, "c": (1, 2), "d": (1, 2, 1)}
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=2)
+    results = run_stages({"a": Stage(barrier.wait), "b": Stage(barrier.wait)})
+    assert set(results) == {"a", "b"}
+
+
+def test_unknown_dependency_is_rejected():
+    with pytest.raises(ValueError):
+        run_stages({"a": Stage(lambda x: x, "missing")})
+
+
+def test_failure_does_not_wait_for_running_stages():
+    release = threading.Event()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="boom"):
+        run_stages({"fail": Stage(fail), "slow": Stage(lambda: release.wait(5))})
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_dependents_of_a_failed_stage_never_run():
+    ran = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        run_stages({"fail": Stage(fail), "after": Stage(ran.append, "fail")})
+    assert ran == []
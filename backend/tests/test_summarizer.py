@@ -0,0 +1,195 @@
+import io
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("openai")
+pytest.importorskip("Bio")
+
+from src import summarizer  # noqa: E402
+from src.cache import DiskCache  # noqa: E402
+
+EFETCH_XML = b"""<?xml version="1.0"?>
+<PubmedArticleSet>
+  <PubmedArticle>
+    <MedlineCitation>
+      <PMID>111</PMID>
+      <Article>
+        <ArticleTitle>Fever in adults</ArticleTitle>
+        <Abstract><AbstractText>A case of fever.</AbstractText></Abstract>
+      </Article>
+    </MedlineCitation>
+  </PubmedArticle>
+</PubmedArticleSet>
+"""
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, payload=None, content=b""):
+        self.status_code = status_code
+        self.payload = payload
+        self.raw = io.BytesIO(content)
+
+    def json(self):
+        return self.payload
+
+
+class FakeNcbi:
+    """Answers esearch from {query: ids or FakeResponse} and efetch with EFETCH_XML"""
+
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def get(self, url, params=None, **kwargs):
+        self.calls.append(("esearch", params["term"]))
+        result = self.results.get(params["term"], [])
+        if isinstance(result, FakeResponse):
+            return result
+        return FakeResponse(payload={"esearchresult": {"idlist": result}})
+
+    def post(self, url, data=None, **kwargs):
+        self.calls.append(("efetch", data["id"]))
+        return FakeResponse(content=EFETCH_XML)
+
+
+class FakeOpenAI:
+    def __init__(self, reply='{"notes": "summary"}'):
+        self.reply = reply
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, messages):
+        self.calls += 1
+        message = type("Message", (), {"content": self.reply})
+        choice = type("Choice", (), {"message": message})
+        return type("Response", (), {"choices": [choice]})
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    """A fresh in-memory cache, no rate limit waits and no real network calls"""
+    monkeypatch.setattr(summarizer, "pubmed_cache", DiskCache(":memory:"))
+    monkeypatch.setattr(summarizer, "ncbi_rate_limit", 1000.0)
+    monkeypatch.setattr(summarizer, "ncbi_retries", 0)
+    monkeypatch.setattr(summarizer, "client", FakeOpenAI())
+
+
+def use_ncbi(monkeypatch, results):
+    ncbi = FakeNcbi(results)
+    monkeypatch.setattr(summarizer.requests, "get", ncbi.get)
+    monkeypatch.setattr(summarizer.requests, "post", ncbi.post)
+    return ncbi
+
+
+def test_probe_tiers_keeps_priority_order(monkeypatch):
+    use_ncbi(monkeypatch, {"tier 1": [], "tier 2": ["2"], "tier 3": ["3"]})
+
+    assert summarizer.probe_tiers(["tier 1", "tier 2", "tier 3"]) == (2, "tier 2", ["2"])
+
+
+def test_probe_tiers_cancels_lower_tiers_once_one_wins(monkeypatch):
+    ncbi = use_ncbi(monkeypatch, {"tier 1": ["1"], "tier 2": ["2"], "tier 3": ["3"]})
+    # One request per second, so lower tiers are still waiting when tier 1 wins
+    monkeypatch.setattr(summarizer, "ncbi_rate_limit", 1.0)
+    monkeypatch.setattr(summarizer, "_ncbi_next_slot", 0.0)
+
+    assert summarizer.probe_tiers(["tier 1", "tier 2", "tier 3"]) == (1, "tier 1", ["1"])
+    time.sleep(1.5)
+    assert ncbi.calls == [("esearch", "tier 1")]
+
+
+def test_probe_tiers_without_results(monkeypatch):
+    use_ncbi(monkeypatch, {})
+
+    assert summarizer.probe_tiers(["tier 1", "tier 2"]) == (None, None, [])
+
+
+def test_rate_limited_tier_is_an_error_not_empty(monkeypatch):
+    use_ncbi(
+        monkeypatch,
+        {
+            "tier 1": FakeResponse(429, {"error": "API rate limit exceeded"}),
+            "tier 2": ["2"],
+        },
+    )
+
+    with pytest.raises(summarizer.NcbiError):
+        summarizer.probe_tiers(["tier 1", "tier 2"])
+
+
+def test_error_payload_is_not_cached(monkeypatch):
+    ncbi = use_ncbi(monkeypatch, {"fever": FakeResponse(200, {"error": "busy"})})
+    with pytest.raises(summarizer.NcbiError):
+        summarizer.search_pubmed("fever")
+
+    ncbi.results["fever"] = ["111"]
+    assert summarizer.search_pubmed("fever") == ["111"]
+
+
+def test_esearch_results_are_refreshed_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.cache.time.time", lambda: now[0])
+    ncbi = use_ncbi(monkeypatch, {"fever": ["111"]})
+
+    summarizer.search_pubmed("fever")
+    summarizer.search_pubmed("fever")
+    assert len(ncbi.calls) == 1
+
+    now[0] += summarizer.esearch_cache_ttl + 1
+    summarizer.search_pubmed("fever")
+    assert len(ncbi.calls) == 2
+
+
+def test_warm_request_makes_no_network_calls(monkeypatch):
+    ncbi = use_ncbi(monkeypatch, {"fever": ["111"]})
+
+    cold = summarizer.summarize_articles(summarizer.search_pubmed("fever"))
+    assert [call[0] for call in ncbi.calls] == ["esearch", "efetch"]
+    assert summarizer.client.calls == 1
+
+    ncbi.calls.clear()
+    summarizer.client.calls = 0
+    warm = summarizer.summarize_articles(summarizer.search_pubmed("fever"))
+
+    assert warm == cold == [
+        {"name": "Fever in adults", "pubmed_id": "111", "summary": {"notes": "summary"}}
+    ]
+    assert ncbi.calls == []
+    assert summarizer.client.calls == 0
+
+
+def test_malformed_summary_is_not_cached(monkeypatch):
+    summarizer.client.reply = "not json"
+    assert summarizer.summarize_structured("An abstract.") == "not json"
+
+    summarizer.client.reply = '{"notes": "fixed"}'
+    assert summarizer.summarize_structured("An abstract.") == '{"notes": "fixed"}'
+    assert summarizer.summarize_structured("An abstract.") == '{"notes": "fixed"}'
+    assert summarizer.client.calls == 2
+
+
+class FakeSummaryStore:
+    def __init__(self):
+        self.saved = {}
+
+    def get_emr_summary(self, patient_id, fingerprint):
+        return self.saved.get((patient_id, fingerprint))
+
+    def save_emr_summary(self, patient_id, fingerprint, summary):
+        self.saved[(patient_id, fingerprint)] = summary
+
+
+def test_malformed_patient_summary_is_not_saved():
+    records = {"id": "p1", "gender": "female", "age": 40, "conditions": [], "observations": []}
+    db = FakeSummaryStore()
+
+    summarizer.client.reply = "not json"
+    assert summarizer.cached_patient_summary(db, records) == {"raw_summary": "not json"}
+    assert db.saved == {}
+
+    summarizer.client.reply = '{"conditions_summary": "none"}'
+    assert summarizer.cached_patient_summary(db, records) == {"conditions_summary": "none"}
+    assert list(db.saved.values()) == [{"conditions_summary": "none"}]